@@ -1,249 +1,96 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
-import sys, os, time, re, datetime, queue, html, sqlite3, configparser, codecs
+import sys, os, re, datetime, queue, sqlite3, configparser, threading, logging
+from collections import OrderedDict, deque
+from logging.handlers import RotatingFileHandler
 
 from PyQt5.QtWidgets import *
 from PyQt5.QtGui import *
-from PyQt5.QtCore import QObject, QDir, QThread, QMutex, pyqtSignal, Qt, QSize, pyqtSlot, QFile, QTextStream
+from PyQt5.QtCore import QDir, QThread, QTimer, pyqtSignal, Qt, QSize, pyqtSlot, QFile, QTextStream
 from PyQt5.QtWinExtras import QWinTaskbarProgress, QWinTaskbarButton
 
 # from darkstyle import DarkStyle
 from logoview import RCLogoView
 
-import auslab
-
 import numpy as np
 import cv2
 
 import keyboard
-import yaml
 
 from peewee import *
 
+from database import PatientDatabase
+from maintenance import DatabaseMaintenance
+from precheck import AuslabPreCheck
+from processing import Configuration, NotAuslabImageError
+from registry import RecognizerRegistry
+from resultcache import ResultCache
+import imagebridge
+import pipeline
+from metrics import metrics
+import processing
+import rendering
+import resultcache
+
 import win32con
 from win32clipboard import *
 
 import qdarkstyle
 
-RTF_TEST_STRING = "{\\rtf1\\ansi{\\fonttbl\\f0\\fswiss Consolas;}\\f0\\pard \nThis is some {\\b bold} text.\\par \n}"
-
-# START EXCERPT - From https://stackoverflow.com/questions/4020539/process-escape-sequences-in-a-string-in-python
-ESCAPE_SEQUENCE_RE = re.compile(r'''
-    ( \\U........      # 8-digit hex escapes
-    | \\u....          # 4-digit hex escapes
-    | \\x..            # 2-digit hex escapes
-    | \\[0-7]{1,3}     # Octal escapes
-    | \\N\{[^}]+\}     # Unicode characters by name
-    | \\[\\'"abfnrtv]  # Single-character escapes
-    )''', re.UNICODE | re.VERBOSE)
-
-def decode_escapes(s):
-    def decode_match(match):
-        return codecs.decode(match.group(0), 'unicode-escape')
-
-    return ESCAPE_SEQUENCE_RE.sub(decode_match, s)
-# END EXCERPT
-
-AUSLAB_MINIMUM_WIDTH = 1008
-AUSLAB_MINIMUM_HEIGHT = 730
-AUSLAB_MINIMUM_BLACK = 80
-
-AUSLAB_MINIMUM_WIDTH_LARGE = 1258
-AUSLAB_MINIMUM_HEIGHT_LARGE = 910
-
-PATIENT_NAME_REGEX = re.compile(r'Name:\s+(.*)DOB:')
-PATIENT_UR_REGEX = re.compile(r'UR No:\s+[A-Z]{2,3}(\d{6})')
-PATIENT_DOB_REGEX = re.compile(r'DOB:\s+(\d{2}-\w{3}-\d{2})')
-LAB_NO_REGEX = re.compile(r'Lab No:\s+([0-9\-]+)')
-COLL_REGEX = re.compile(r'Coll:\s+(\d{2}:\d{2}\s+\d{2}-\w{3}-\d{2})')
-
-TEST_REGEX = {
-    'Hb' : re.compile(r'Hgb\s+:\s+(\d+)\s+[ HLC]'),
-    'WBC' : re.compile(r'[EW]BC\s+:\s+([0-9\.]+)\s+[ HLC]'),
-    'Plt' : re.compile(r'PLT\s+:\s+(\d+)\s+[ HLC]'),
-    'Na' : re.compile(r'Sodium\s+(\d+)\s+'),
-    'K' : re.compile(r'Potassium\s+([0-9\.]+)\s+'),
-    'Cr' : re.compile(r'Creatinine\s+(\<?\>?\s*\d+)\s+'),
-    'Mg' : re.compile(r'Magnesium\s+([0-9\.]+)\s+'),
-    'Ca' : re.compile(r'Corr Ca\s+([0-9\.]+)\s+'),
-    'Ph' : re.compile(r'Phosphate\s+([0-9\.]+)\s+'),
-    'eGFR' : re.compile(r'eGFR\s+(\<?\>?\s*\d+)\s+'),
-    'CRP' : re.compile(r'CRP\s+(\<?[0-9\.]+)'),
-    'AST' : re.compile(r'AST\s+(\d+)'),
-    'ALT' : re.compile(r'ALT\s+(\d+)'),
-    'GGT' : re.compile(r'Gamma GT\s+(\d+)'),
-    'ALP' : re.compile(r'ALP\s+(\d+)'),
-    'LD' : re.compile(r'LD\s+(\d+)'),
-    'INR' : re.compile(r'INR\s+([0-9\.]+)'),
-    'ESR' : re.compile(r'ESR\s+(\d+)'),
-    'Neut' : re.compile(r'Neut.*?:\s+([0-9\.]+)'),
-    'Lymph' : re.compile(r'Lymph.*?:\s+([0-9\.]+)'),
-    'Mono' : re.compile(r'Mono.*?:\s+([0-9\.]+)'),
-    'Eosin' : re.compile(r'Eosin.*?:\s+([0-9\.]+)'),
-    'Baso' : re.compile(r'Baso.*?:\s+([0-9\.]+)'),
-    'FreeT4' : re.compile(r'Free T4.*?:\s+([0-9\.]+)'),
-    'TSH' : re.compile(r'TSH\s+([0-9\.]+)'),
-    'B12' : re.compile(r'Vitamin B12\s+([0-9\.]+)'),
-    'Folate' : re.compile(r'Folate\s+([0-9\.]+)'),
-    'VitD' : re.compile(r'25-Hydroxy-Vitamin D\s+([0-9\.]+)'),
-    'Iron' : re.compile(r'Iron\s+(\<?\>?\s*[0-9\.]+)'),
-    'Transferrin' : re.compile(r'Transferrin\s+([0-9\.]+)'),
-    'TransferrinSat' : re.compile(r'Transferrin Saturation\s+(\<?\>?\s*[0-9\.]+)'),
-    'Ferritin' : re.compile(r'Ferritin\s+([0-9\.]+)'),
-}
-
-database_proxy = Proxy()
-
-class Configuration:
-
-    instance = None
-
-    def __init__(self, config_filename):
-        self.config = yaml.safe_load(config_filename)
-
-    @staticmethod
-    def current():
-        if Configuration.instance is None:
-            Configuration.instance = Configuration(open('config.yaml', 'r'))
-        return Configuration.instance.config
-
-class BaseModel(Model):
-    class Meta:
-        database = database_proxy
-        
-class Patient(BaseModel):
-    UR = CharField()
-    name = CharField()
-    DOB = CharField()
-
-    def add_test_result(self, lab_number, test_datetime, test_name, result, auslab_color):
-        # And overwrite
-        lab_test_group = None
+# Everything logged goes here; the debug pane and the log file each take the levels they are configured for
+logger = logging.getLogger('assist')
 
-        try:
-            lab_test_group = self.lab_test_groups.select().where(LabTestGroup.lab_number == lab_number).get()
-        except LabTestGroup.DoesNotExist:
-            lab_test_group = LabTestGroup(patient=self, lab_number=lab_number, datetime=test_datetime)
-            lab_test_group.save()
+LOG_FORMAT = '[%(asctime)s] %(message)s'
+LOG_DATE_FORMAT = '%d-%m-%Y %H:%M:%S'
+LOG_FILE_MAX_BYTES = 5 * 1024 * 1024
+LOG_FILE_BACKUP_COUNT = 5
 
-        try:
-            lab_test = lab_test_group.lab_tests.select().where(LabTest.name == test_name).get()
-            lab_test.value = result
-            lab_test.auslab_color = auslab_color
-            lab_test.save()
-            return
-        except LabTest.DoesNotExist:
-            lab_test = LabTest(lab_test_group=lab_test_group, name=test_name, value=result, auslab_color=auslab_color)
-            lab_test.save()
+RTF_TEST_STRING = "{\\rtf1\\ansi{\\fonttbl\\f0\\fswiss Consolas;}\\f0\\pard \nThis is some {\\b bold} text.\\par \n}"
 
-    def getPasteableTests(self, lab_number, format_string, key_list, output_mime_type, non_green_bolding=False):
-        lab_test_group = None
-        try:
-            lab_test_group = self.lab_test_groups.select().where(LabTestGroup.lab_number == lab_number).get()
-        except LabTestGroup.DoesNotExist:
-            # print('No lab results exist for the given lab number {}'.format(lab_number))
-            return ''
-
-        lab_tests = {}
-        for lab_test in lab_test_group.lab_tests:
-            lab_tests[lab_test.name] = lab_test.value
-
-        # print('Test RTF string:\n{}'.format(RTF_TEST_STRING))
-        # print('Raw format string:\n{}'.format(format_string))
-        output_string = decode_escapes(format_string)
-
-        # print('Post escape decoding output string:\n{}'.format(output_string))
-
-        if output_mime_type == 'application/rtf':
-            # This has to be the world's shittiest RTF colour substitution code
-            # Will need to consider colour table -> assume default already in format strings, or replace with our own in actual output?
-            # Also have to use colour correspondence -> "green" values in AUSLAB should probably just be black/grey in output -> how can we customise this?
-            # Decision: Let the format string determine the colour table, with a predefined/convention index correspondence between colour names and entries, as this allows for customisation:
-            colour_table = {
-                "green" : 1,
-                "yellow" : 2,
-                "red" : 3,
-                "orange" : 4,
-                "blue" : 5,
-            }
-
-            format_results = {}
-            for key in key_list:
-                relevant_test = [x for x in lab_test_group.lab_tests if x.name == key]
-                if len(relevant_test) > 0:
-                    relevant_test = relevant_test[0]
-                    # print('{} - {}'.format(relevant_test[0].name, relevant_test[0].auslab_color))
-                    if non_green_bolding and relevant_test.auslab_color != 'green':
-                        format_results[key] = '{{\\b\\cf{} {}}}'.format(colour_table[relevant_test.auslab_color], relevant_test.value)
-                    else:
-                        format_results[key] = '{{\\cf{} {}}}'.format(colour_table[relevant_test.auslab_color], relevant_test.value)
-                else:
-                    format_results[key] = '-'
-            output_string = output_string.format(**format_results)
-            # print('RTF output string: \n{}'.format(output_string))
-            return output_string
-        else:
-            # Life is easy, assume text/plain, simply replace the values
-            format_results = {}
-            for key in key_list:
-                format_results[key] = lab_tests.get(key, '-')
-
-            output_string = output_string.format(**format_results)
-            print('Output string: \n{}'.format(output_string))
-            return output_string
-
-
-class LabTestGroup(BaseModel):
-    patient = ForeignKeyField(Patient, backref='lab_test_groups')
-    lab_number = CharField()
-    datetime = CharField()
-
-class LabTest(BaseModel):
-    lab_test_group = ForeignKeyField(LabTestGroup, backref='lab_tests')
-    name = CharField()
-    value = CharField()
-    # Don't want to add 'choices' here because there may be new colours added later
-    # It will therefore be the responsibility of the calling object to use the data appropriately
-    auslab_color = CharField(null = True, default="green")
-
-class PatientDatabase(QObject):
-    log = pyqtSignal(str)
+class LogBufferHandler(logging.Handler):
+    # Collects log lines from any thread for the debug pane, dropping the oldest once capacity lines are waiting
 
-    def __init__(self, db_path):
+    def __init__(self, capacity):
         super().__init__()
-        self.patients = {}
-        self.db_path = db_path
-        self.db = SqliteDatabase(db_path)
-        database_proxy.initialize(self.db)
-        self.db.create_tables([Patient, LabTestGroup, LabTest])
-        self.db_lock = QMutex()
-
-    def save(self):
-        self.db_lock.lock()
-        for UR, patient in self.patients.items():
-            self.log.emit('Patient: {0}'.format(UR))
-        self.db_lock.unlock()
-
-    def add_patient(self, UR, name, DOB):
-        self.db_lock.lock()
-        patient = None
-        try:
-            patient = Patient.get(Patient.UR == UR)
-            self.log.emit('Patient exist {}'.format(UR))
-        except Patient.DoesNotExist:
-            patient = Patient(UR=UR, name=name, DOB=DOB)
-            self.log.emit('Patient did not exist {}'.format(UR))
-        patient.save()
-        self.patients[UR] = patient
-        self.db_lock.unlock()
-        return patient
+        self.buffer = deque(maxlen=capacity)
+
+    def emit(self, record):
+        self.buffer.append(self.format(record))
+
+    def drain(self):
+        lines = []
+        while True:
+            try:
+                lines.append(self.buffer.popleft())
+            except IndexError:
+                return lines
+
+def configure_logging(config):
+    # Returns the level of messages shown in the debug pane
+    file_level = logging.getLevelName(config['main'].get('log_file_level', 'INFO'))
+    view_level = logging.getLevelName(config['main'].get('log_view_level', 'INFO'))
+    log_path = config['main'].get('log_path')
+    levels = [view_level]
+    if log_path:
+        if os.path.dirname(log_path):
+            os.makedirs(os.path.dirname(log_path), exist_ok=True)
+        file_handler = RotatingFileHandler(log_path, maxBytes=LOG_FILE_MAX_BYTES, backupCount=LOG_FILE_BACKUP_COUNT, encoding='utf-8')
+        file_handler.setFormatter(logging.Formatter('[%(asctime)s] %(levelname)s %(threadName)s: %(message)s'))
+        file_handler.setLevel(file_level)
+        logger.addHandler(file_handler)
+        levels.append(file_level)
+    # Messages below every handler's level are discarded before they are even formatted
+    logger.setLevel(min(levels))
+    logger.propagate = False
+    return view_level
 
 class ProcessClipboardImageThread(QThread):
     log = pyqtSignal(str)
     message = pyqtSignal(str)
     processing = pyqtSignal(str, int, int)
     clipboard = pyqtSignal(str)
+    rendered = pyqtSignal(str, dict)
     lines_complete = pyqtSignal()
 
     def __init__(self, assist_widget, config):
@@ -251,22 +98,48 @@ class ProcessClipboardImageThread(QThread):
         self.enabled = True
         self.assist_widget = assist_widget
         self.image_queue = self.assist_widget.image_queue
-        self.image_queue_lock = self.assist_widget.image_queue_lock
+        self.recognizer_registry = self.assist_widget.recognizer_registry
+        self.auslab_precheck = self.assist_widget.auslab_precheck
         self.patient_db = PatientDatabase(Configuration.current()['main']['database_path'])
         self.patient_db.log.connect(self.logMessage)
         self.last_UR = None
         self.config = config
         self.auslab_image = None
-        self.match_patterns = None
+        self.test_extractor = None
+        self.test_extractor_patterns = None
+        self.renderers = rendering.compile_output_strings(self.config)
+        self.screen_recognizer = processing.IncrementalScreenRecognizer()
+        self.recognition_pool = processing.RecognitionPool.fromConfig(self.config)
+        self.result_cache = None
+        result_cache_size_mb = self.config['main'].get('result_cache_size_mb', resultcache.DEFAULT_RESULT_CACHE_SIZE_MB)
+        if result_cache_size_mb > 0:
+            result_cache_path = self.config['main'].get('result_cache_path') or resultcache.default_cache_path(self.config['main']['database_path'])
+            self.result_cache = ResultCache(result_cache_path, result_cache_size_mb * 1024 * 1024)
+        metrics.configure(self.config['main'].get('metrics_directory'))
+        self.in_flight = 0
+        self.in_flight_lock = threading.Lock()
+        self.pipeline = self.createPipeline()
+        self.maintenance = DatabaseMaintenance.fromConfig(self.config, self.patient_db, self.isIdle)
 
     def logMessage(self, message_str):
         self.log.emit(message_str)
 
+    def isIdle(self):
+        with self.in_flight_lock:
+            return self.in_flight == 0
+
     def processingStart(self):
+        with self.in_flight_lock:
+            self.in_flight += 1
         self.processing.emit('start', -1, -1)
 
     def processingStop(self):
-        self.processing.emit('stop', -1, -1)
+        # Screenshots overlap in the pipeline, so the status only returns to waiting once the last one is finished
+        with self.in_flight_lock:
+            self.in_flight -= 1
+            finished = self.in_flight == 0
+        if finished:
+            self.processing.emit('stop', -1, -1)
 
     def processingUpdate(self, step, total_steps):
         self.processing.emit('update', step, total_steps)
@@ -280,140 +153,240 @@ class ProcessClipboardImageThread(QThread):
             self.log.emit('Pasting last UR...')
             keyboard.write(self.last_UR)
 
-    def _getMatchPatterns(self):
-        if self.match_patterns is None:
-            self.match_patterns = {}
-            for mp in self.config['main']['match_patterns']:
-                self.match_patterns[mp['name']] = re.compile(mp['regex'])
-
-        return self.match_patterns
+    def _getTestExtractor(self):
+        # Follows configuration reloads, so that the patterns used always match the result cache fingerprint
+        match_patterns = self.recognizer_registry.matchPatterns()
+        if self.test_extractor is None or self.test_extractor_patterns is not match_patterns:
+            self.test_extractor = processing.TestExtractor(match_patterns)
+            self.test_extractor_patterns = match_patterns
+
+        return self.test_extractor
+
+    def nextImage(self):
+        # Blocks until a screenshot arrives.  Screenshots taken in a burst are coalesced so that only the most recent
+        # one is processed; None is the shutdown sentinel
+        qimage = self.image_queue.get()
+        superseded = 0
+        # This thread is the only consumer, so the queue cannot empty between the check and the get
+        while qimage is not None and not self.image_queue.empty():
+            qimage = self.image_queue.get_nowait()
+            superseded += 1
+        if qimage is not None and superseded > 0:
+            self.log.emit('Skipped {} superseded screenshot(s)'.format(superseded))
+        return qimage
+
+    def stop(self):
+        self.enabled = False
+        self.image_queue.put(None)
+
+    def notAuslabImage(self):
+        metrics.increment('images_rejected')
+        self.message.emit('Not an AUSLAB image')
+        self.log.emit('Not an AUSLAB image.')
+
+    def createPipeline(self):
+        # Screenshots are processed in overlapping stages, so that a second screenshot is loaded while the first is
+        # still being recognized.  The stages share in-memory images and recognizers, so they run on threads
+        pipeline_config = self.config['main'].get('pipeline') or {}
+        queue_size = pipeline_config.get('queue_size', pipeline.DEFAULT_QUEUE_SIZE)
+        stages_config = pipeline_config.get('stages') or {}
+        stages = [pipeline.Stage.fromConfig(name, metrics.timed('pipeline.' + name, fn), stages_config.get(name), queue_size) for name, fn in [
+            ('load', self.loadStage),
+            ('recognize', self.recognizeStage),
+            ('extract', self.extractStage),
+        ]]
+        return pipeline.Pipeline(stages, self.handleStageError)
+
+    def handleStageError(self, stage_name, job, e):
+        self.log.emit('Error while processing screenshot ({} stage): {}'.format(stage_name, e))
+        self.processingStop()
 
     def run(self):
-        def not_auslab_image_message():
-            self.message.emit('Not an AUSLAB image')
-            self.log.emit('Not an AUSLAB image.')
-
         self.log.emit('*** ProcessClipboardImageThread started ***')
-        keyboard.add_hotkey('ctrl+shift+x', self.pasteLastUR)
-
-        auslab_config = Configuration.current()['auslab']
-        recognizer = auslab.AuslabTemplateRecognizer(auslab_config)
-
-        current_qimage = None
+        paste_hotkey = keyboard.add_hotkey('ctrl+shift+x', self.pasteLastUR)
 
+        self.pipeline.start()
         while self.enabled:
-            while current_qimage is None:
-                self.image_queue_lock.lock()
-                if self.image_queue.empty():
-                    self.image_queue_lock.unlock()
-                    time.sleep(0.5)
-                else:
-                    current_qimage = self.image_queue.get()
-                    self.image_queue_lock.unlock()
-
-            self.log.emit('Converting image format...')
-            self.processingStart()
-            current_qimage = current_qimage.convertToFormat(QImage.Format_RGB32)
-
-            ai = auslab.AuslabImage(auslab_config)
-            ai.loadScreenshot(current_qimage)
-
-            self.auslab_image = ai
-
-            recognizer = None
-            if ai.size == ai.AUSLAB_SIZE_LARGE:
-                recognizer = auslab.AuslabTemplateRecognizer(auslab_config['large'])
-            elif ai.size == ai.AUSLAB_SIZE_NORMAL:
-                recognizer = auslab.AuslabTemplateRecognizer(auslab_config['normal'])
-            else:
-                # TODO: USE EXCEPTIONS
-                print('[Critical Errror] Unknown image size, cannot instantiate recognizer')
-                not_auslab_image_message()
-                current_qimage = None
-                self.processingStop()
-                continue
-                # sys.exit(1)
-
-            if ai.valid:
-                self.log.emit("AUSLAB image identified.")
-                # self.auslab_image.getCenterLineCharColor(5, 11)
-
-                # ai.getHeaderLines()
-                # ai.getCenterLines()
-
-                ## self.lines_complete.emit()
-
-                raw_header_lines = ai.getHeaderLines()
-                raw_center_lines = ai.getCenterLines()
-
-                header_lines = []
-                center_lines = []
-
-                total_lines = len(raw_header_lines) + len(raw_center_lines)
-
-                # Given that colour detection is now an additional processing burden, we now assume that processing the initial text represents approximately only 80% of the work
-                total_steps = int(total_lines * 1.25)
-
-                for i, raw_header_line in enumerate(raw_header_lines):
-                    header_lines.append(recognizer.recognizeLine(raw_header_line))
-                    self.processing.emit('update', i+1, total_steps)
-
-                for i, raw_center_line in enumerate(raw_center_lines):
-                    center_lines.append(recognizer.recognizeLine(raw_center_line))
-                    self.processing.emit('update', i+1+len(raw_header_lines), total_steps)
-
-                # header_lines = [recognizer.recognizeLine(x) for x in ai.getHeaderLines()]
-                # center_lines = [recognizer.recognizeLine(x) for x in ai.getCenterLines()]
-
-                UR = PATIENT_UR_REGEX.search(header_lines[0]).group(1)
-                name = PATIENT_NAME_REGEX.search(header_lines[1]).group(1)
-                DOB = PATIENT_DOB_REGEX.search(header_lines[1]).group(1)
-                collection_time = COLL_REGEX.search(header_lines[0]).group(1)
-                lab_number = LAB_NO_REGEX.search(header_lines[0]).group(1)
-
-                self.last_UR = UR
-
-                self.log.emit('UR: {0}'.format(UR))
-                self.log.emit('Name: {0}'.format(name))
-                self.log.emit('DOB: {0}'.format(DOB))
-                self.log.emit('Collection time: {0}'.format(collection_time))
-                self.log.emit('Lab No: {0}'.format(lab_number))
-                
-                current_patient = self.patient_db.add_patient(UR, name, DOB)
-
-                for line in header_lines:
-                    self.log.emit(line)
-
-                for line in center_lines:
-                    self.log.emit(line)
-
-                for i, line in enumerate(center_lines):
-                    # self.log.emit(line)
-                    for tk,tr in self._getMatchPatterns().items():
-                        try:
-                            result = tr.search(line)
-                            if result is None:
-                                continue # to next line
-                            result_match = result.group('result')
-                            color = ai.getCenterLineCharColor(i, result.span('result')[0])
-                            self.log.emit('Determined colour for {} as {}'.format(tk, color))
-                            # self.log.emit('Found {} with value {} and colour {}'.format(tk, result_match, color))
-                            current_patient.add_test_result(lab_number, collection_time, tk, result_match, color)
-                        except IndexError:
-                            continue # to next line
-                clipboard_data = current_patient.getPasteableTests(lab_number, self.assist_widget.getCurrentOutputString(), [x['name'] for x in self.config['main']['match_patterns']], self.assist_widget.formatType.text(), Configuration.current()['main']['non_green_bolding'])
-                self.processing.emit('update', total_steps, total_steps)
-
-                # clipboard_data = 'There is no pasteable data'
-                self.log.emit(clipboard_data)
-                self.clipboard.emit(clipboard_data)
-                self.message.emit('AUSLAB image processed')
-                self.processingStop()
-            else:
-                not_auslab_image_message()
+            current_qimage = self.nextImage()
+            if current_qimage is None:
+                break
+            # Blocks while the first stage is busy, during which newer screenshots are coalesced in the image queue
+            self.pipeline.put({'qimage' : current_qimage})
+        self.pipeline.stop()
+        if self.recognition_pool is not None:
+            self.recognition_pool.shutdown()
+
+        keyboard.remove_hotkey(paste_hotkey)
+        self.log.emit('*** ProcessClipboardImageThread stopped ***')
+
+    def loadStage(self, job):
+        self.processingStart()
+        current_qimage = job['qimage']
+
+        if self.auslab_precheck is not None:
+            # The rest of the pre-check, too slow for the clipboard handler on large images
+            rejection = self.auslab_precheck.checkF1Button(current_qimage)
+            if rejection is not None:
+                metrics.increment('images_rejected')
+                self.log.emit('Ignoring clipboard image, not an AUSLAB screenshot: {}'.format(rejection))
                 self.processingStop()
+                return None
 
-            current_qimage = None
+        cache_key = None
+        if self.result_cache is not None:
+            cache_key = resultcache.image_digest(current_qimage, self.recognizer_registry.recognitionFingerprint())
+            cached = self.result_cache.get(cache_key)
+            if cached is not None:
+                self.log.emit('Screenshot already processed, using cached results.')
+                metrics.increment('result_cache_hits')
+                self.processCachedResults(cached)
+                return None
+
+        self.log.emit('Converting image format...')
+
+        # Taken per image so that configuration reloads apply to the next screenshot
+        auslab_config = self.recognizer_registry.auslabConfig()
+        # Clipboard screenshots are usually 32 bit already, in which case the frame is not copied
+        rgb32_qimage = imagebridge.as_rgb32(current_qimage)
+        ai = processing.load_auslab_image(rgb32_qimage, auslab_config)
+
+        self.auslab_image = ai
+
+        try:
+            recognizer = self.recognizer_registry.get(processing.get_size_config(ai, auslab_config)['name'])
+        except NotAuslabImageError as e:
+            self.log.emit(str(e))
+            self.notAuslabImage()
+            self.processingStop()
+            return None
+
+        if not ai.valid:
+            self.notAuslabImage()
+            self.processingStop()
+            return None
+
+        self.log.emit("AUSLAB image identified.")
+        metrics.increment('images_accepted')
+        # self.auslab_image.getCenterLineCharColor(5, 11)
+
+        ## self.lines_complete.emit()
+
+        # The images stay with the job until it is finished, as the AuslabImage shares their pixels
+        return {'qimage' : current_qimage, 'rgb32_qimage' : rgb32_qimage, 'auslab_image' : ai, 'recognizer' : recognizer, 'cache_key' : cache_key}
+
+    def recognizeStage(self, job):
+        ai = job['auslab_image']
+        recognizer = job['recognizer']
+
+        raw_header_lines = ai.getHeaderLines()
+        raw_center_lines = ai.getCenterLines()
+
+        total_lines = len(raw_header_lines) + len(raw_center_lines)
+
+        # Given that colour detection is now an additional processing burden, we now assume that processing the initial text represents approximately only 80% of the work
+        total_steps = int(total_lines * 1.25)
+
+        if self.config['main'].get('incremental_recognition', True):
+            header_lines, center_lines = self.screen_recognizer.recognize(recognizer, raw_header_lines, raw_center_lines, self.processingUpdate, total_steps, self.recognition_pool)
+            self.log.emit('Reused {} of {} lines from the previous screenshot'.format(self.screen_recognizer.reused_count, total_lines))
+            metrics.increment('lines_reused', self.screen_recognizer.reused_count)
+        else:
+            header_lines, center_lines = processing.recognize_screen(recognizer, raw_header_lines, raw_center_lines, self.processingUpdate, total_steps, self.recognition_pool)
+        if getattr(recognizer, 'glyph_cache', None) is not None:
+            glyph_cache_stats = recognizer.glyph_cache.stats()
+            self.log.emit('Glyph cache: {entries} entries, {hits} hits, {misses} misses ({hit_rate:.1%} hit rate)'.format(**glyph_cache_stats))
+            for key in ['entries', 'hits', 'misses']:
+                metrics.setGauge('glyph_cache_' + key, glyph_cache_stats[key])
+
+        job.update({'header_lines' : header_lines, 'center_lines' : center_lines, 'total_steps' : total_steps})
+        return job
+
+    def extractStage(self, job):
+        ai = job['auslab_image']
+        header_lines = job['header_lines']
+        center_lines = job['center_lines']
+
+        try:
+            header = processing.parse_header(header_lines)
+        except NotAuslabImageError as e:
+            self.log.emit(str(e))
+            self.notAuslabImage()
+            self.processingStop()
+            return None
+
+        self.logHeader(header)
+
+        # Per line output is only produced when a log handler is taking debug messages
+        for line in header_lines:
+            logger.debug(line)
+
+        for line in center_lines:
+            logger.debug(line)
+
+        test_results = processing.extract_test_results(center_lines, self._getTestExtractor(), ai.getCenterLineCharColor)
+        for tk, result_match, color in test_results:
+            logger.debug('Determined colour for {} as {}'.format(tk, color))
+        metrics.increment('patterns_matched', len(test_results))
+
+        # Saving and rendering happen on the database writer thread, so this stage can move on to the next image
+        self.patient_db.submit(self.saveAndRender, header, test_results)
+
+        if job['cache_key'] is not None:
+            self.result_cache.put(job['cache_key'], header, header_lines, center_lines, test_results)
+
+        self.processing.emit('update', job['total_steps'], job['total_steps'])
+        self.processingStop()
+        return None
+
+    def logHeader(self, header):
+        self.last_UR = header['UR']
+
+        self.log.emit('UR: {0}'.format(header['UR']))
+        self.log.emit('Name: {0}'.format(header['name']))
+        self.log.emit('DOB: {0}'.format(header['DOB']))
+        self.log.emit('Collection time: {0}'.format(header['collection_time']))
+        self.log.emit('Lab No: {0}'.format(header['lab_number']))
+
+    def processCachedResults(self, cached):
+        self.logHeader(cached['header'])
+        self.patient_db.submit(self.saveAndRender, cached['header'], cached['results'], only_if_missing=True)
+        self.processingStop()
+
+    def saveAndRender(self, header, test_results, only_if_missing=False):
+        # Runs on the database writer thread
+        with metrics.span('save_and_render'):
+            current_patient = self.patient_db.add_patient(header['UR'], header['name'], header['DOB'])
+            # Cached results are only written again if they have since been removed from the database
+            if not only_if_missing or not current_patient.has_lab_number(header['lab_number']):
+                current_patient.add_test_results(header['lab_number'], header['collection_time'], test_results)
+            self.renderClipboard(current_patient, header['lab_number'])
+        self.message.emit('AUSLAB image processed')
+        self.reportMetrics()
+
+    def reportMetrics(self):
+        # The screenshot is finished once its results are on the clipboard
+        try:
+            metrics.export()
+        except OSError as e:
+            self.log.emit('Unable to export metrics: {}'.format(e))
+        for line in metrics.summary():
+            logger.info('[metrics] ' + line)
+
+    @metrics.spanned('render')
+    def renderClipboard(self, current_patient, lab_number):
+        # Every output format is rendered up front so that switching formats later needs no database access
+        lab_results = current_patient.get_lab_results(lab_number)
+        # Earlier results are only looked up for output strings with history placeholders, e.g. {hb.prev}
+        history_depth = max([x.history_depth for x in self.renderers.values()], default=0)
+        history_names = set().union(*[x.history_names for x in self.renderers.values()])
+        history = current_patient.get_test_history(history_names, lab_number, history_depth)
+        outputs = {name : renderer.render(lab_results, history) for name, renderer in self.renderers.items()}
+        self.rendered.emit(lab_number, outputs)
+        clipboard_data = outputs.get(self.assist_widget.formatComboBox.currentText(), '')
+
+        # clipboard_data = 'There is no pasteable data'
+        self.log.emit(clipboard_data)
+        self.clipboard.emit(clipboard_data)
 
 class Assist(QWidget):
     # logsig = pyqtSignal(str)
@@ -422,9 +395,16 @@ class Assist(QWidget):
 
     VERSION_FILENAME = 'version-number.txt'
 
-    def __init__(self, config):
+    # Number of lab groups whose rendered outputs are kept for format switching and re-copying
+    RENDERED_OUTPUT_CACHE_SIZE = 8
+
+    LOG_VIEW_MAX_LINES = 2000
+    LOG_FLUSH_INTERVAL_MS = 200
+
+    def __init__(self, config, log_view_level=logging.INFO):
         super().__init__()
         self.config = config
+        self.log_view_level = log_view_level
         self.initUI()
 
     def initUI(self):
@@ -439,6 +419,10 @@ class Assist(QWidget):
         with open(self.VERSION_FILENAME) as f:
             version_number = f.readline()
 
+        # lab number -> {output string name: rendered text}, most recently processed last
+        self.rendered_outputs = OrderedDict()
+        self.last_lab_number = None
+
         output_string_names = [x['name'] for x in self.config['main']['output_strings']]
         self.formatComboBox = QComboBox()
         self.formatComboBox.addItems(output_string_names)
@@ -454,10 +438,19 @@ class Assist(QWidget):
 
         self.handleOutputStringChanged()
         
-        self.log_lock = QMutex()
-        self.log = QTextEdit()
+        # Log lines are buffered and added in batches, and only the most recent LOG_VIEW_MAX_LINES are kept
+        self.log = QPlainTextEdit()
         self.log.setReadOnly(True)
-        self.log.document().setDefaultStyleSheet('* { font-family: Consolas; } span.logmessage { color: #FFFFFF; white-space: pre; }')
+        self.log.setMaximumBlockCount(self.LOG_VIEW_MAX_LINES)
+        self.log.setStyleSheet('font-family: Consolas; color: #FFFFFF;')
+        self.log_handler = LogBufferHandler(self.LOG_VIEW_MAX_LINES)
+        self.log_handler.setFormatter(logging.Formatter(LOG_FORMAT, LOG_DATE_FORMAT))
+        self.log_handler.setLevel(self.log_view_level)
+        logger.addHandler(self.log_handler)
+        self.log_timer = QTimer(self)
+        self.log_timer.setInterval(self.LOG_FLUSH_INTERVAL_MS)
+        self.log_timer.timeout.connect(self.flushLog)
+        self.log_timer.start()
 
         self.layout = QVBoxLayout(self)
         # self.layout.addWidget(self.processingLogo)
@@ -512,16 +505,37 @@ class Assist(QWidget):
         QApplication.clipboard().dataChanged.connect(self.handleClipboardChanged)
 
         self.image_queue = queue.Queue()
-        self.image_queue_lock = QMutex()
+
+        # Most unrelated clipboard images are rejected here rather than by the processing thread
+        self.auslab_precheck = None
+        if self.config['main'].get('auslab_precheck', True):
+            try:
+                self.auslab_precheck = AuslabPreCheck(self.config['auslab'])
+            except Exception as e:
+                self.logMessage('Unable to load F1 templates, not pre-checking clipboard images: {}'.format(e))
+
+        # Recognizers are loaded in the background at startup, before the first screenshot needs them
+        self.recognizer_registry = RecognizerRegistry()
+        self.recognizer_registry.log.connect(self.handleLogMessage)
+        self.recognizer_registry.warmUp()
 
         self.image_processing_thread = ProcessClipboardImageThread(self, self.config)
         self.image_processing_thread.message.connect(self.handleProcessThreadMessage)
         self.image_processing_thread.log.connect(self.handleLogMessage)
         self.image_processing_thread.clipboard.connect(self.handleClipboardMessage)
+        self.image_processing_thread.rendered.connect(self.handleRenderedOutputs)
         self.image_processing_thread.processing.connect(self.handleProcessingStateChange)
         self.image_processing_thread.lines_complete.connect(self.handleLinesComplete)
         self.image_processing_thread.start()
 
+        # Retention, compaction and statistics run on the database writer thread between screenshots
+        maintenance_interval_minutes = self.config['main'].get('maintenance_interval_minutes', 60)
+        self.maintenance_timer = QTimer(self)
+        if maintenance_interval_minutes > 0:
+            self.maintenance_timer.setInterval(maintenance_interval_minutes * 60 * 1000)
+            self.maintenance_timer.timeout.connect(self.image_processing_thread.maintenance.start)
+            self.maintenance_timer.start()
+
         self.header_line_window = None
 
         self.last_clipboard_content = ''
@@ -542,9 +556,7 @@ class Assist(QWidget):
     def handleLinesComplete(self):
 
         def ndarray_to_qlabel(ndarray):
-            data = ndarray.copy()
-            qimage = QImage(data, data.shape[1], data.shape[0], data.strides[0], QImage.Format_Grayscale8)
-            qpixmap = QPixmap(qimage)
+            qpixmap = QPixmap.fromImage(imagebridge.ndarray_to_qimage(ndarray))
             qlabel = QLabel()
             qlabel.setPixmap(qpixmap)
             qlabel.resize(qpixmap.width(), qpixmap.height())
@@ -605,6 +617,24 @@ class Assist(QWidget):
         # print(output_html)
         self.formatText.setHtml(output_html)
 
+        # Swap the clipboard to the newly selected format of the last processed results straight away
+        rendered_output = self.getRenderedOutput()
+        if rendered_output is not None:
+            self.handleClipboardMessage(rendered_output)
+
+    def getRenderedOutput(self):
+        outputs = self.rendered_outputs.get(self.last_lab_number)
+        if outputs is None:
+            return None
+        return outputs.get(self.formatComboBox.currentText())
+
+    def handleRenderedOutputs(self, lab_number, outputs):
+        self.rendered_outputs[lab_number] = outputs
+        self.rendered_outputs.move_to_end(lab_number)
+        while len(self.rendered_outputs) > self.RENDERED_OUTPUT_CACHE_SIZE:
+            self.rendered_outputs.popitem(last=False)
+        self.last_lab_number = lab_number
+
     def handleProcessingStateChange(self, message_str, step, total_steps):
         COMPLETED_CHAR = '*'
         # COMPLETED_CHAR = '█'
@@ -636,7 +666,8 @@ class Assist(QWidget):
 
     @pyqtSlot()
     def handleRepeatButtonClicked(self):
-        self.handleClipboardMessage(self.last_clipboard_content)
+        rendered_output = self.getRenderedOutput()
+        self.handleClipboardMessage(rendered_output if rendered_output is not None else self.last_clipboard_content)
         # print('Repeat button pressed.')
 
     @pyqtSlot()
@@ -673,23 +704,28 @@ class Assist(QWidget):
         qimage = QApplication.clipboard().image()
         if qimage.isNull():
             return
-        self.image_queue_lock.lock()
+        if self.auslab_precheck is not None:
+            rejection = self.auslab_precheck.checkBackground(qimage)
+            if rejection is not None:
+                metrics.increment('images_rejected')
+                self.logMessage('Ignoring clipboard image, not an AUSLAB screenshot: {}'.format(rejection))
+                return
         self.image_queue.put(qimage)
-        self.image_queue_lock.unlock()
         self.logMessage('Image waiting in queue...')
 
     def logMessage(self, message):
-        self.log_lock.lock()
-        dt = datetime.datetime.now()
-        datestr = dt.strftime('%d-%m-%Y %H:%M:%S')
-        # print('At End: {}'.format(self.log.textCursor().atEnd()))
-        textCursor = self.log.textCursor()
-        textCursor.movePosition(QTextCursor.End)
-        self.log.setTextCursor(textCursor)
-        # print('Move successful: {}'.format(self.log.textCursor().movePosition(QTextCursor.End)))
-        self.log.insertHtml('<span style=""><span style="color: #888888;">[{0}]</span> <span class="logmessage">{1}</span></span><br />'.format(datestr, html.escape(message)))
-        self.log.verticalScrollBar().setValue(self.log.verticalScrollBar().maximum())
-        self.log_lock.unlock()
+        logger.info(message)
+
+    def flushLog(self):
+        lines = self.log_handler.drain()
+        if len(lines) == 0:
+            return
+        scroll_bar = self.log.verticalScrollBar()
+        # Only follow new output if the view was already at the end
+        following = scroll_bar.value() == scroll_bar.maximum()
+        self.log.appendPlainText('\n'.join(lines))
+        if following:
+            scroll_bar.setValue(scroll_bar.maximum())
 
     def handleClipboardMessage(self, content):
         self.last_clipboard_content = content
@@ -715,6 +751,15 @@ class Assist(QWidget):
         if self.header_line_window is not None:
             self.header_line_window.close()
         self.trayIcon.hide()
+        self.maintenance_timer.stop()
+        # Let the image being processed finish, so its results are saved before the database is closed
+        self.image_processing_thread.stop()
+        self.image_processing_thread.wait()
+        processing.flush_glyph_caches()
+        self.image_processing_thread.patient_db.close()
+        if self.image_processing_thread.result_cache is not None:
+            self.image_processing_thread.result_cache.close()
+        logging.shutdown()
 
     def bringFocus(self):
         current_flags = self.windowFlags()
@@ -733,6 +778,7 @@ def main():
     config = Configuration.current()
     # print(config)
     db_path = config['main']['database_path']
+    log_view_level = configure_logging(config)
 
     app = QApplication(sys.argv)
     app.setApplicationName('Assist')
@@ -741,7 +787,7 @@ def main():
 
     _id = QFontDatabase().addApplicationFont('ArameMono.ttf')
 
-    assist = Assist(config)
+    assist = Assist(config, log_view_level)
     # keyboard.add_hotkey('ctrl+shift+a', bringFocus, args=(assist,))
     sys.exit(app.exec_())
 
@@ -9,6 +9,8 @@ a = Analysis(['assist.py'],
                 ('config.yaml', '.'), 
                 ('templates-normal.dat', '.'),
                 ('templates-large.dat', '.'),
+                ('templates-normal.glyphs', '.'),
+                ('templates-large.glyphs', '.'),
                 ('rc-logo.png', '.'),
                 ('F1_normal.png', '.'), 
                 ('F1_condensed.png', '.'),
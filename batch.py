@@ -0,0 +1,182 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Headless batch processing of archived AUSLAB screenshots, e.g.:
+#   python batch.py --output results.json --workers 8 ./screenshots
+#   python batch.py --format csv --output results.csv --no-database F1_normal.png F1_large_condensed.png
+
+import sys, os, argparse, json, csv, multiprocessing
+
+from PyQt5.QtGui import QImage
+
+from database import PatientDatabase
+from processing import Configuration, NotAuslabImageError
+import imagebridge
+import processing
+
+IMAGE_EXTENSIONS = ('.png', '.bmp', '.jpg', '.jpeg')
+
+CSV_FIELDS = ['path', 'UR', 'name', 'DOB', 'lab_number', 'collection_time', 'test', 'value', 'color', 'error']
+
+# Per-process state, populated by _initWorker() so that each worker loads the configuration and templates only once
+_worker = {}
+
+def _initWorker(config_path):
+    config = Configuration.load(config_path)
+    _worker['config'] = config
+    _worker['test_extractor'] = processing.TestExtractor.fromConfig(config)
+    _worker['recognizers'] = {}
+
+def _getRecognizer(size_config):
+    recognizers = _worker['recognizers']
+    if size_config['name'] not in recognizers:
+        recognizers[size_config['name']] = processing.create_recognizer(size_config, _worker['config'])
+    return recognizers[size_config['name']]
+
+def process_screenshot(path):
+    # Any failure is reported against its screenshot, so one bad image cannot stop the rest of the batch
+    try:
+        return _processScreenshot(path)
+    except Exception as e:
+        return {'path' : path, 'error' : '{}: {}'.format(type(e).__name__, e)}
+
+def _processScreenshot(path):
+    auslab_config = _worker['config']['auslab']
+
+    qimage = QImage(path)
+    if qimage.isNull():
+        return {'path' : path, 'error' : 'Unable to load image'}
+
+    try:
+        qimage = imagebridge.as_rgb32(qimage)
+        ai = processing.load_auslab_image(qimage, auslab_config)
+        recognizer = _getRecognizer(processing.get_size_config(ai, auslab_config))
+        if not ai.valid:
+            raise NotAuslabImageError('Not an AUSLAB image')
+
+        header_lines, center_lines = processing.recognize_screen(recognizer, ai.getHeaderLines(), ai.getCenterLines())
+        header = processing.parse_header(header_lines)
+        test_results = processing.extract_test_results(center_lines, _worker['test_extractor'], ai.getCenterLineCharColor)
+    except NotAuslabImageError as e:
+        return {'path' : path, 'error' : str(e)}
+
+    return {
+        'path' : path,
+        'header' : header,
+        'header_lines' : header_lines,
+        'center_lines' : center_lines,
+        'results' : test_results,
+    }
+
+def find_screenshots(paths, recursive=False):
+    screenshots = []
+    for path in paths:
+        if os.path.isdir(path):
+            if recursive:
+                for dirpath, dirnames, filenames in os.walk(path):
+                    dirnames.sort()
+                    screenshots.extend(os.path.join(dirpath, x) for x in sorted(filenames) if x.lower().endswith(IMAGE_EXTENSIONS))
+            else:
+                screenshots.extend(os.path.join(path, x) for x in sorted(os.listdir(path)) if x.lower().endswith(IMAGE_EXTENSIONS))
+        else:
+            screenshots.append(path)
+    return screenshots
+
+class JSONResultWriter:
+    def __init__(self, f):
+        self.f = f
+        self.count = 0
+        self.f.write('[\n')
+
+    def write(self, result):
+        if self.count > 0:
+            self.f.write(',\n')
+        self.f.write(json.dumps(result))
+        self.count += 1
+
+    def close(self):
+        self.f.write('\n]\n')
+
+class CSVResultWriter:
+    def __init__(self, f):
+        self.writer = csv.DictWriter(f, fieldnames=CSV_FIELDS)
+        self.writer.writeheader()
+
+    def write(self, result):
+        # One row per test result, or a single row carrying the error
+        if 'error' in result:
+            self.writer.writerow({'path' : result['path'], 'error' : result['error']})
+            return
+        for test, value, color in result['results']:
+            row = {'path' : result['path'], 'test' : test, 'value' : value, 'color' : color}
+            row.update(result['header'])
+            self.writer.writerow(row)
+
+    def close(self):
+        pass
+
+def save_results(patient_db, result):
+    header = result['header']
+    patient = patient_db.add_patient(header['UR'], header['name'], header['DOB'])
+    patient.add_test_results(header['lab_number'], header['collection_time'], result['results'])
+
+def main():
+    parser = argparse.ArgumentParser(description='Process AUSLAB screenshots without the GUI.')
+    parser.add_argument('paths', nargs='+', help='screenshot files or directories of screenshots')
+    parser.add_argument('-c', '--config', default='config.yaml', help='configuration file (default: config.yaml)')
+    parser.add_argument('-o', '--output', default='-', help='output file (default: stdout)')
+    parser.add_argument('-f', '--format', choices=['json', 'csv'], default=None, help='output format (default: from output extension, otherwise json)')
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count(), help='number of worker processes (default: CPU count)')
+    parser.add_argument('-r', '--recursive', action='store_true', help='search directories recursively')
+    parser.add_argument('--no-database', action='store_true', help='do not write results to the patient database')
+    args = parser.parse_args()
+
+    config = Configuration.load(args.config)
+
+    output_format = args.format
+    if output_format is None:
+        output_format = 'csv' if args.output.lower().endswith('.csv') else 'json'
+
+    screenshots = find_screenshots(args.paths, args.recursive)
+    if len(screenshots) == 0:
+        print('No screenshots found.', file=sys.stderr)
+        return 1
+
+    patient_db = None
+    if not args.no_database:
+        patient_db = PatientDatabase(config['main']['database_path'])
+
+    output_file = sys.stdout if args.output == '-' else open(args.output, 'w', newline='', encoding='utf-8')
+    writer = JSONResultWriter(output_file) if output_format == 'json' else CSVResultWriter(output_file)
+
+    processed = 0
+    failed = 0
+    try:
+        # The database is only ever written from this process, the workers only do image processing and recognition
+        with multiprocessing.Pool(args.workers, initializer=_initWorker, initargs=(args.config,)) as pool:
+            for result in pool.imap(process_screenshot, screenshots, chunksize=4):
+                if 'error' not in result and patient_db is not None:
+                    try:
+                        save_results(patient_db, result)
+                    except Exception as e:
+                        result = dict(result, error='Unable to save results: {}: {}'.format(type(e).__name__, e))
+                if 'error' in result:
+                    failed += 1
+                    print('{}: {}'.format(result['path'], result['error']), file=sys.stderr)
+                else:
+                    processed += 1
+                writer.write(result)
+    finally:
+        # Leaves valid output for everything processed so far, even if the batch is interrupted
+        writer.close()
+        if output_file is not sys.stdout:
+            output_file.close()
+        if patient_db is not None:
+            patient_db.close()
+
+    print('Processed {} of {} screenshots ({} failed).'.format(processed, len(screenshots), failed), file=sys.stderr)
+    # Non-zero if any screenshot failed, so that scripts notice
+    return 1 if failed > 0 else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,94 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Lookup latency of the patient database as it grows, with and without the schema indexes, e.g.:
+#   python benchmarks/bench_database.py --sizes 10000 100000 1000000
+
+import sys, os, argparse, random, tempfile, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import PatientDatabase, Patient, LabTestGroup, LabTest
+from rendering import OutputRenderer
+
+TESTS_PER_GROUP = 40
+GROUPS_PER_PATIENT = 5
+LOOKUPS = 500
+
+# Indexes added by the schema migrations, dropped for the --without-indexes comparison
+MIGRATION_INDEXES = ['patient_UR', 'labtestgroup_lab_number', 'labtestgroup_patient_id_lab_number', 'labtest_name', 'labtest_lab_test_group_id_name']
+
+def populate(patient_db, result_count):
+    group_count = max(1, result_count // TESTS_PER_GROUP)
+    patient_count = max(1, group_count // GROUPS_PER_PATIENT)
+    db = patient_db.db
+    with db.atomic():
+        cursor = db.cursor()
+        cursor.executemany('INSERT INTO patient (id, UR, name, DOB) VALUES (?, ?, ?, ?)',
+            ((i, '{:06d}'.format(i), 'PATIENT {}'.format(i), '01-Jan-50') for i in range(1, patient_count + 1)))
+        cursor.executemany('INSERT INTO labtestgroup (id, patient_id, lab_number, datetime) VALUES (?, ?, ?, ?)',
+            ((i, (i % patient_count) + 1, '{:05d}-{:05d}'.format(i // 100000, i % 100000), '10:00 01-Jan-20') for i in range(1, group_count + 1)))
+        cursor.executemany('INSERT INTO labtest (lab_test_group_id, name, value, auslab_color) VALUES (?, ?, ?, ?)',
+            ((g, 'test{}'.format(t), str(random.randint(1, 200)), 'green') for g in range(1, group_count + 1) for t in range(TESTS_PER_GROUP)))
+    return patient_count, group_count
+
+def percentile(samples, fraction):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+def measure(name, fn, arguments):
+    samples = []
+    for argument in arguments:
+        start = time.perf_counter()
+        fn(*argument)
+        samples.append((time.perf_counter() - start) * 1000)
+    print('  {:<28} p50 {:8.3f} ms   p95 {:8.3f} ms'.format(name, percentile(samples, 0.5), percentile(samples, 0.95)))
+
+def run(result_count, with_indexes):
+    handle, path = tempfile.mkstemp(suffix='.sqlite3')
+    os.close(handle)
+    os.remove(path)
+    try:
+        patient_db = PatientDatabase(path)
+        if not with_indexes:
+            for index in MIGRATION_INDEXES:
+                patient_db.db.execute_sql('DROP INDEX IF EXISTS {}'.format(index))
+        patient_count, group_count = populate(patient_db, result_count)
+        patient_db.db.execute_sql('ANALYZE')
+
+        print('{} results ({} patients, {} lab groups), {}:'.format(result_count, patient_count, group_count, 'indexed' if with_indexes else 'without indexes'))
+        patients = [('{:06d}'.format(random.randint(1, patient_count)),) for i in range(LOOKUPS)]
+        groups = [(Patient.get(Patient.UR == x[0]), None) for x in patients[:100]]
+        groups = [(p, p.lab_test_groups.get().lab_number) for p, x in groups]
+        format_string = ' '.join('{test' + str(t) + '}' for t in range(TESTS_PER_GROUP))
+
+        measure('Patient by UR', lambda UR: Patient.get(Patient.UR == UR), patients)
+        measure('LabTestGroup by lab number', lambda p, n: p.has_lab_number(n), groups)
+        measure('LabTest by name', lambda p, n: LabTest.select().join(LabTestGroup).where((LabTestGroup.lab_number == n) & (LabTest.name == 'test7')).get(), groups)
+        if with_indexes:
+            # Upserts rely on the unique indexes
+            measure('add_test_results', lambda p, n: p.add_test_results(n, '10:00 01-Jan-20', [('test1', '1', 'green'), ('test2', '2', 'red')]), groups)
+        renderer = OutputRenderer('benchmark', 'application/rtf', format_string, True)
+        measure('render (RTF)', lambda p, n: renderer.render(p.get_lab_results(n)), groups)
+        patient_db.close()
+        print('  {:<28} {:8.1f} MB'.format('database size', os.path.getsize(path) / (1024 * 1024)))
+    finally:
+        for suffix in ['', '-wal', '-shm']:
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark patient database lookups at increasing sizes.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000], help='numbers of lab test results to generate')
+    parser.add_argument('--without-indexes', action='store_true', help='also run each size without the migration indexes')
+    args = parser.parse_args()
+
+    random.seed(0)
+    for result_count in args.sizes:
+        run(result_count, True)
+        if args.without_indexes:
+            run(result_count, False)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,293 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Per-stage latency of the screenshot pipeline on the bundled screenshots, checked against golden transcripts and
+# against a saved baseline, e.g.:
+#   python benchmarks/bench_pipeline.py --record-goldens --save-baseline
+#   python benchmarks/bench_pipeline.py --variants original bordered scaled --threshold 0.2
+# Exits with 1 if any recognized line, header or result differs from benchmarks/goldens.json, if a stage is slower
+# than its baseline p50 by more than the threshold, or if either file has not been recorded.  Both are recorded from
+# a run of the recognizer and committed, the goldens once the transcripts have been checked against the screenshots.
+
+import sys, os, argparse, json, tempfile, time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from PyQt5.QtCore import Qt
+from PyQt5.QtGui import QImage, QPainter
+
+import yaml
+
+import imagebridge
+import processing
+import rendering
+from database import PatientDatabase
+from precheck import AuslabPreCheck
+from processing import NotAuslabImageError
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+GOLDENS_PATH = os.path.join(BENCHMARK_DIR, 'goldens.json')
+DEFAULT_BASELINE_PATH = os.path.join(BENCHMARK_DIR, 'baseline-pipeline.json')
+
+FIXTURES = ['rescale-output.png']
+# The F1 button references are what the pre-check searches for, so they are timed as images of their own
+REFERENCE_IMAGES = ['F1_normal.png', 'F1_condensed.png', 'F1_large_normal.png', 'F1_large_condensed.png']
+
+STAGES = ['load', 'precheck', 'auslab image', 'recognize line', 'recognize screen', 'extract', 'database upsert', 'render', 'end to end']
+
+def percentile(samples, fraction):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+def timed(samples, stage, fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    samples.setdefault(stage, []).append((time.perf_counter() - start) * 1000)
+    return result
+
+def bordered(qimage):
+    # The screenshot inside a larger black frame, as when the window does not fill the capture
+    frame = QImage(qimage.width() + 12, qimage.height() + 40, QImage.Format_RGB32)
+    frame.fill(Qt.black)
+    painter = QPainter(frame)
+    painter.drawImage(6, 30, qimage)
+    painter.end()
+    return frame
+
+def scaled(qimage):
+    return qimage.scaled(int(qimage.width() * 1.25), int(qimage.height() * 1.25), Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
+
+VARIANTS = {
+    'original' : lambda qimage: qimage,
+    'bordered' : bordered,
+    'scaled' : scaled,
+}
+
+class PipelineBenchmark:
+
+    def __init__(self, config, database_path):
+        self.config = config
+        self.auslab_config = config['auslab']
+        self.precheck = AuslabPreCheck(self.auslab_config)
+        self.test_extractor = processing.TestExtractor.fromConfig(config)
+        self.renderers = rendering.compile_output_strings(config)
+        self.recognizers = {}
+        self.patient_db = PatientDatabase(database_path)
+
+    def recognizer(self, size_config):
+        if size_config['name'] not in self.recognizers:
+            recognizer = processing.create_recognizer(size_config, self.config)
+            if hasattr(recognizer, 'warmUp'):
+                recognizer.warmUp()
+            self.recognizers[size_config['name']] = recognizer
+        return self.recognizers[size_config['name']]
+
+    def process(self, qimage, samples):
+        # Runs every stage once, timing each.  Returns (header, header lines, center lines, results) or raises
+        # NotAuslabImageError
+        start = time.perf_counter()
+        qimage = timed(samples, 'load', imagebridge.as_rgb32, qimage)
+        timed(samples, 'precheck', self.precheck.check, qimage)
+
+        def load():
+            ai = processing.load_auslab_image(qimage, self.auslab_config)
+            if not ai.valid:
+                raise NotAuslabImageError('Not an AUSLAB image')
+            return ai, processing.get_size_config(ai, self.auslab_config), ai.getHeaderLines(), ai.getCenterLines()
+        ai, size_config, raw_header_lines, raw_center_lines = timed(samples, 'auslab image', load)
+        recognizer = self.recognizer(size_config)
+
+        for raw_line in list(raw_header_lines) + list(raw_center_lines):
+            timed(samples, 'recognize line', recognizer.recognizeLine, raw_line)
+        header_lines, center_lines = timed(samples, 'recognize screen', processing.recognize_screen, recognizer, raw_header_lines, raw_center_lines)
+
+        def extract():
+            header = processing.parse_header(header_lines)
+            return header, processing.extract_test_results(center_lines, self.test_extractor, ai.getCenterLineCharColor)
+        header, test_results = timed(samples, 'extract', extract)
+
+        def upsert():
+            patient = self.patient_db.add_patient(header['UR'], header['name'], header['DOB'])
+            patient.add_test_results(header['lab_number'], header['collection_time'], test_results)
+            return patient
+        patient = timed(samples, 'database upsert', upsert)
+
+        def render():
+            lab_results = patient.get_lab_results(header['lab_number'])
+            return {name : renderer.render(lab_results) for name, renderer in self.renderers.items()}
+        timed(samples, 'render', render)
+
+        samples.setdefault('end to end', []).append((time.perf_counter() - start) * 1000)
+        return header, header_lines, center_lines, test_results
+
+    def close(self):
+        self.patient_db.close()
+
+def golden_record(header, header_lines, center_lines, test_results):
+    return {
+        'header' : {key : value.strip() for key, value in header.items()},
+        'header_lines' : header_lines,
+        'center_lines' : center_lines,
+        'results' : {name : [value, colour] for name, value, colour in test_results},
+    }
+
+def golden_differences(golden, header, header_lines, center_lines, test_results):
+    differences = []
+    for key, lines in [('header_lines', header_lines), ('center_lines', center_lines)]:
+        expected_lines = golden.get(key)
+        if expected_lines is None:
+            differences.append('no {} transcript in the goldens, record them with --record-goldens'.format(key))
+            continue
+        if len(lines) != len(expected_lines):
+            differences.append('{}: expected {} lines, recognized {}'.format(key, len(expected_lines), len(lines)))
+        for i, (expected, actual) in enumerate(zip(expected_lines, lines)):
+            if actual != expected:
+                differences.append('{} {}: expected {!r}, recognized {!r}'.format(key, i, expected, actual))
+    for key, expected in golden['header'].items():
+        actual = header.get(key, '').strip()
+        if actual != expected:
+            differences.append('header {}: expected {!r}, recognized {!r}'.format(key, expected, actual))
+    results = {name : [value, colour] for name, value, colour in test_results}
+    for name, expected in golden['results'].items():
+        if results.get(name) != expected:
+            differences.append('{}: expected {!r}, recognized {!r}'.format(name, expected, results.get(name)))
+    return differences
+
+def summarize(samples):
+    summary = {}
+    for stage in STAGES:
+        if stage in samples:
+            summary[stage] = {
+                'p50' : percentile(samples[stage], 0.5),
+                'p95' : percentile(samples[stage], 0.95),
+                'count' : len(samples[stage]),
+            }
+    if 'end to end' in summary:
+        summary['end to end']['images_per_second'] = 1000 / summary['end to end']['p50']
+    return summary
+
+def print_summary(name, summary):
+    print('{}:'.format(name))
+    for stage, stats in summary.items():
+        print('  {:<18} p50 {:9.3f} ms   p95 {:9.3f} ms'.format(stage, stats['p50'], stats['p95']))
+    if 'end to end' in summary:
+        print('  {:<18} {:9.1f} images/s'.format('throughput', summary['end to end']['images_per_second']))
+
+def compare_baseline(results, baseline, threshold):
+    regressions = []
+    for name, summary in results.items():
+        for stage, stats in summary.items():
+            baseline_stats = baseline.get(name, {}).get(stage)
+            if baseline_stats is None:
+                continue
+            if stats['p50'] > baseline_stats['p50'] * (1 + threshold):
+                regressions.append('{} / {}: p50 {:.3f} ms, baseline {:.3f} ms'.format(name, stage, stats['p50'], baseline_stats['p50']))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the screenshot pipeline stage by stage on the bundled screenshots.')
+    parser.add_argument('-c', '--config', default=os.path.join(ROOT, 'config.yaml'), help='configuration file')
+    parser.add_argument('-n', '--repeat', type=int, default=20, help='times each image is processed')
+    parser.add_argument('--variants', nargs='+', default=['original'], choices=sorted(VARIANTS), help='synthetic variants of each screenshot to run')
+    parser.add_argument('--glyph-cache', action='store_true', help='keep the in-memory glyph cache enabled between repeats')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE_PATH, help='baseline JSON file')
+    parser.add_argument('--save-baseline', action='store_true', help='store these results as the new baseline')
+    parser.add_argument('--record-goldens', action='store_true', help='store what is recognized in the original screenshots as the new goldens')
+    parser.add_argument('--threshold', type=float, default=0.25, help='allowed p50 slowdown against the baseline, as a fraction')
+    parser.add_argument('-o', '--output', help='also write the results to this JSON file')
+    args = parser.parse_args()
+
+    # Template and F1 paths in the configuration are relative to the application directory
+    os.chdir(ROOT)
+    with open(args.config, 'r') as f:
+        config = yaml.safe_load(f)
+    # Repeats must measure recognition rather than a disk cache left by earlier runs
+    config['main']['glyph_cache_path'] = None
+    if not args.glyph_cache:
+        config['main']['glyph_cache_size'] = 0
+    goldens = {}
+    if os.path.exists(GOLDENS_PATH):
+        with open(GOLDENS_PATH, 'r') as f:
+            goldens = json.load(f)
+
+    handle, database_path = tempfile.mkstemp(suffix='.sqlite3')
+    os.close(handle)
+    os.remove(database_path)
+    benchmark = PipelineBenchmark(config, database_path)
+
+    results = {}
+    failures = []
+    try:
+        for reference in REFERENCE_IMAGES:
+            samples = {}
+            for i in range(args.repeat):
+                qimage = timed(samples, 'load', QImage, reference)
+                timed(samples, 'precheck', benchmark.precheck.check, qimage)
+            results[reference] = summarize(samples)
+            print_summary(reference, results[reference])
+
+        for fixture in FIXTURES:
+            source = QImage(fixture)
+            if source.isNull():
+                failures.append('{}: unable to load'.format(fixture))
+                continue
+            for variant in args.variants:
+                name = '{} ({})'.format(fixture, variant)
+                qimage = VARIANTS[variant](source)
+                samples = {}
+                for i in range(args.repeat):
+                    try:
+                        # A fresh copy each time, so nothing is reused from the previous repeat's buffer
+                        header, header_lines, center_lines, test_results = benchmark.process(qimage.copy(), samples)
+                    except NotAuslabImageError as e:
+                        # Synthetic variants may legitimately fall outside what AUSLAB detection accepts
+                        if variant == 'original':
+                            failures.append('{}: {}'.format(name, e))
+                        else:
+                            print('{}: rejected ({})'.format(name, e))
+                        break
+                    if i > 0:
+                        continue
+                    if args.record_goldens:
+                        if variant == 'original':
+                            goldens[fixture] = golden_record(header, header_lines, center_lines, test_results)
+                    elif fixture in goldens:
+                        failures.extend('{}: {}'.format(name, x) for x in golden_differences(goldens[fixture], header, header_lines, center_lines, test_results))
+                    else:
+                        failures.append('{}: no goldens, record them with --record-goldens'.format(name))
+                results[name] = summarize(samples)
+                print_summary(name, results[name])
+    finally:
+        benchmark.close()
+        for suffix in ['', '-wal', '-shm']:
+            if os.path.exists(database_path + suffix):
+                os.remove(database_path + suffix)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.record_goldens:
+        with open(GOLDENS_PATH, 'w') as f:
+            json.dump(goldens, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print('Goldens saved to {}, check the transcripts before committing them'.format(GOLDENS_PATH))
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print('Baseline saved to {}'.format(args.baseline))
+    elif os.path.exists(args.baseline):
+        with open(args.baseline, 'r') as f:
+            regressions = compare_baseline(results, json.load(f), args.threshold)
+        failures.extend('regression {}'.format(x) for x in regressions)
+    else:
+        failures.append('no baseline at {}, record one with --save-baseline'.format(args.baseline))
+
+    for failure in failures:
+        print('FAIL {}'.format(failure))
+    return 1 if len(failures) > 0 else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
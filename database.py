@@ -0,0 +1,238 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import re, datetime, logging
+from concurrent.futures import ThreadPoolExecutor
+
+from PyQt5.QtCore import QObject, QMutex, pyqtSignal
+
+from peewee import *
+
+import migrations
+from metrics import metrics
+
+database_proxy = Proxy()
+
+# Schema upgrades run while the database is opened, before anything can be connected to PatientDatabase.log
+logger = logging.getLogger('assist.database')
+
+# journal_mode=wal lets the GUI read while the writer thread commits, and synchronous=normal is durable under WAL.
+# auto_vacuum only takes effect on new databases, existing ones are switched over with
+# python maintenance.py --enable-incremental-vacuum
+DATABASE_PRAGMAS = (
+    ('auto_vacuum', 'incremental'),
+    ('journal_mode', 'wal'),
+    ('synchronous', 'normal'),
+    ('cache_size', -16 * 1024),
+    ('mmap_size', 64 * 1024 * 1024),
+    ('temp_store', 'memory'),
+)
+
+# Rows per INSERT statement, keeping well below SQLite's limit on bound variables
+INSERT_BATCH_SIZE = 100
+
+# AUSLAB collection times, e.g. '16:45 30-Aug-19'
+COLLECTION_TIME_FORMAT = '%H:%M %d-%b-%y'
+
+# Results such as '12.4', '<5' or '> 90'
+RESULT_VALUE_RE = re.compile(r'^\s*(?P<comparator>[<>])?\s*(?P<number>[-+]?(?:\d+\.?\d*|\.\d+))\s*$')
+
+# Compact codes for the AUSLAB colours stored in LabTest.colour
+AUSLAB_COLOUR_CODES = {
+    'green' : 1,
+    'yellow' : 2,
+    'red' : 3,
+    'orange' : 4,
+    'blue' : 5,
+}
+
+def parse_result_value(value):
+    # Returns (number, comparator) - comparator is '<', '>' or None, and both are None for non-numeric results
+    match = RESULT_VALUE_RE.match(value or '')
+    if match is None:
+        return None, None
+    return float(match.group('number')), match.group('comparator')
+
+def typed_result_columns(value, auslab_color):
+    # The parsed columns stored beside each raw result, for filtering and aggregating inside SQLite
+    value_num, comparator = parse_result_value(value)
+    return {'value_num' : value_num, 'comparator' : comparator, 'colour' : AUSLAB_COLOUR_CODES.get(auslab_color)}
+
+def parse_collection_time(collection_time):
+    # None if the time cannot be read, in which case the result is left out of history lookups
+    try:
+        return datetime.datetime.strptime(collection_time.strip(), COLLECTION_TIME_FORMAT)
+    except (AttributeError, ValueError):
+        return None
+
+class BaseModel(Model):
+    class Meta:
+        database = database_proxy
+        
+class Patient(BaseModel):
+    UR = CharField(unique=True)
+    name = CharField()
+    DOB = CharField()
+
+    def _updateHistory(self, lab_test_group, results):
+        collected_at = parse_collection_time(lab_test_group.datetime)
+        rows = [{'patient' : self, 'name' : test_name, 'lab_number' : lab_test_group.lab_number, 'collected_at' : collected_at, 'value' : result, 'auslab_color' : auslab_color}
+            for test_name, result, auslab_color in results]
+        for batch in chunked(rows, INSERT_BATCH_SIZE):
+            (LabTestHistory
+                .insert_many(batch)
+                .on_conflict(conflict_target=[LabTestHistory.patient, LabTestHistory.name, LabTestHistory.lab_number], preserve=[LabTestHistory.collected_at, LabTestHistory.value, LabTestHistory.auslab_color])
+                .execute())
+
+    @metrics.spanned('database.add_test_results')
+    def add_test_results(self, lab_number, test_datetime, results):
+        # Writes all (test name, result, AUSLAB colour) tuples of a screenshot in a single transaction, overwriting any
+        # existing values for the same lab number
+        with database_proxy.atomic():
+            LabTestGroup.insert(patient=self, lab_number=lab_number, datetime=test_datetime).on_conflict_ignore().execute()
+            lab_test_group = LabTestGroup.get((LabTestGroup.patient == self) & (LabTestGroup.lab_number == lab_number))
+
+            rows = [dict(typed_result_columns(result, auslab_color), lab_test_group=lab_test_group, name=test_name, value=result, auslab_color=auslab_color)
+                for test_name, result, auslab_color in results]
+            for batch in chunked(rows, INSERT_BATCH_SIZE):
+                (LabTest
+                    .insert_many(batch)
+                    .on_conflict(conflict_target=[LabTest.lab_test_group, LabTest.name], preserve=[LabTest.value, LabTest.auslab_color, LabTest.value_num, LabTest.comparator, LabTest.colour])
+                    .execute())
+            self._updateHistory(lab_test_group, results)
+        return lab_test_group
+
+    def has_lab_number(self, lab_number):
+        return self.lab_test_groups.select().where(LabTestGroup.lab_number == lab_number).exists()
+
+    @metrics.spanned('database.get_lab_results')
+    def get_lab_results(self, lab_number):
+        # Returns {test name: (value, AUSLAB colour)} for a lab number, loaded with a single query
+        query = (LabTest
+            .select(LabTest.name, LabTest.value, LabTest.auslab_color)
+            .join(LabTestGroup)
+            .where((LabTestGroup.patient == self) & (LabTestGroup.lab_number == lab_number))
+            .tuples())
+        return {name : (value, auslab_color) for name, value, auslab_color in query}
+
+    @metrics.spanned('database.get_test_history')
+    def get_test_history(self, names, lab_number, depth):
+        # Returns {test name: [(value, AUSLAB colour), ...]} of the results collected before lab_number, most recent
+        # first and at most depth per test.  Each test is one ORDER BY ... LIMIT scan of the history index, so only the
+        # rows returned are read however long a patient's history is
+        if depth <= 0 or len(names) == 0:
+            return {}
+        collected_at = (LabTestHistory
+            .select(LabTestHistory.collected_at)
+            .where((LabTestHistory.patient == self) & (LabTestHistory.lab_number == lab_number) & LabTestHistory.collected_at.is_null(False))
+            .limit(1)
+            .scalar())
+        if collected_at is None:
+            return {}
+        history = {}
+        for name in sorted(names):
+            results = list(LabTestHistory
+                .select(LabTestHistory.value, LabTestHistory.auslab_color)
+                .where((LabTestHistory.patient == self) & (LabTestHistory.name == name) & (LabTestHistory.collected_at < collected_at))
+                .order_by(LabTestHistory.collected_at.desc())
+                .limit(depth)
+                .tuples())
+            if len(results) > 0:
+                history[name] = results
+        return history
+
+
+class LabTestGroup(BaseModel):
+    patient = ForeignKeyField(Patient, backref='lab_test_groups')
+    lab_number = CharField(index=True)
+    datetime = CharField()
+
+    class Meta:
+        indexes = (
+            (('patient', 'lab_number'), True),
+        )
+
+class LabTest(BaseModel):
+    lab_test_group = ForeignKeyField(LabTestGroup, backref='lab_tests')
+    name = CharField(index=True)
+    value = CharField()
+    # Don't want to add 'choices' here because there may be new colours added later
+    # It will therefore be the responsibility of the calling object to use the data appropriately
+    auslab_color = CharField(null = True, default="green")
+    # Parsed from value and auslab_color when written: the number, '<' or '>' if the result is a bound, and the
+    # colour as one of AUSLAB_COLOUR_CODES - all null where they do not apply
+    value_num = FloatField(null=True)
+    comparator = CharField(max_length=1, null=True)
+    colour = SmallIntegerField(null=True)
+
+    class Meta:
+        indexes = (
+            (('lab_test_group', 'name'), True),
+            (('name', 'value_num'), False),
+        )
+
+class LabTestHistory(BaseModel):
+    # Every result of a patient's tests with a sortable collection time, kept in step with LabTest by add_test_results,
+    # so that earlier results of a test are read from a single index instead of walking all lab test groups
+    patient = ForeignKeyField(Patient, backref='test_history')
+    name = CharField()
+    lab_number = CharField()
+    collected_at = DateTimeField(null=True)
+    value = CharField()
+    auslab_color = CharField(null=True)
+
+    class Meta:
+        indexes = (
+            (('patient', 'name', 'lab_number'), True),
+            (('patient', 'name', 'collected_at'), False),
+        )
+
+MODELS = [Patient, LabTestGroup, LabTest, LabTestHistory]
+
+class PatientDatabase(QObject):
+    log = pyqtSignal(str)
+
+    def __init__(self, db_path):
+        super().__init__()
+        self.patients = {}
+        self.db_path = db_path
+        self.db = SqliteDatabase(db_path, pragmas=DATABASE_PRAGMAS)
+        database_proxy.initialize(self.db)
+        migrations.upgrade(self.db, MODELS, logger.info)
+        self.db_lock = QMutex()
+        # Writes are queued and run in order on a single thread, so that callers never block on SQLite
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='PatientDatabaseWriter')
+
+    def submit(self, fn, *args, **kwargs):
+        future = self.writer.submit(fn, *args, **kwargs)
+        future.add_done_callback(self._logFailure)
+        return future
+
+    def _logFailure(self, future):
+        if future.exception() is not None:
+            self.log.emit('Database error: {}'.format(future.exception()))
+
+    def close(self):
+        self.writer.shutdown(wait=True)
+        self.db.close()
+
+    def save(self):
+        self.db_lock.lock()
+        for UR, patient in self.patients.items():
+            self.log.emit('Patient: {0}'.format(UR))
+        self.db_lock.unlock()
+
+    @metrics.spanned('database.add_patient')
+    def add_patient(self, UR, name, DOB):
+        self.db_lock.lock()
+        patient = None
+        try:
+            patient = Patient.get(Patient.UR == UR)
+            self.log.emit('Patient exist {}'.format(UR))
+        except Patient.DoesNotExist:
+            patient = Patient(UR=UR, name=name, DOB=DOB)
+            self.log.emit('Patient did not exist {}'.format(UR))
+        patient.save()
+        self.patients[UR] = patient
+        self.db_lock.unlock()
+        return patient
@@ -0,0 +1,201 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Streams the patient database out as one row per lab result, e.g.:
+#   python export.py --output results.csv
+#   python export.py --format jsonl --ur 402710 --since 2019-08-01 --until 2019-09-01 --output hogan.jsonl
+#   python export.py --output results.csv --resume
+# Rows come from a single joined cursor in LabTest id order and are written a chunk at a time, so memory use does not
+# grow with the database.  After each chunk the last exported id and the output size are saved to <output>.state,
+# and --resume carries on from there, dropping anything written after the last saved chunk.
+
+import sys, os, argparse, json, csv, datetime
+
+from peewee import chunked
+
+import yaml
+
+from database import PatientDatabase, Patient, LabTestGroup, LabTest, parse_collection_time
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+EXPORT_FIELDS = ['id', 'UR', 'name', 'DOB', 'lab_number', 'collection_time', 'test', 'value', 'value_num', 'comparator', 'color']
+
+DEFAULT_CHUNK_SIZE = 1000
+
+STATE_EXTENSION = '.state'
+
+DATE_FORMAT = '%Y-%m-%d'
+
+def parse_date(s):
+    try:
+        return datetime.datetime.strptime(s, DATE_FORMAT)
+    except ValueError:
+        raise argparse.ArgumentTypeError('expected YYYY-MM-DD, not {!r}'.format(s))
+
+def export_rows(chunk_size, urs=None, after_id=0):
+    # Chunks of EXPORT_FIELDS tuples, from one query however many patients and groups there are
+    query = (LabTest
+        .select(LabTest.id, Patient.UR, Patient.name, Patient.DOB, LabTestGroup.lab_number, LabTestGroup.datetime,
+            LabTest.name, LabTest.value, LabTest.value_num, LabTest.comparator, LabTest.auslab_color)
+        .join(LabTestGroup)
+        .join(Patient)
+        .where(LabTest.id > after_id)
+        .order_by(LabTest.id))
+    if urs:
+        query = query.where(Patient.UR.in_(urs))
+    return chunked(query.tuples().iterator(), chunk_size)
+
+def collected_between(since, until):
+    # Row filter on the collection time, which is stored as AUSLAB text and so cannot be compared in SQL.  Rows whose
+    # time cannot be read are left out once either bound is given.
+    if since is None and until is None:
+        return None
+    cache = {}
+    def accept(row):
+        collection_time = row[5]
+        if collection_time not in cache:
+            collected_at = parse_collection_time(collection_time)
+            cache.clear()
+            cache[collection_time] = collected_at is not None and (since is None or collected_at >= since) and (until is None or collected_at < until)
+        return cache[collection_time]
+    return accept
+
+class CSVExportWriter:
+    def __init__(self, f, resumed):
+        self.writer = csv.writer(f)
+        if not resumed:
+            self.writer.writerow(EXPORT_FIELDS)
+
+    def write(self, rows):
+        self.writer.writerows(rows)
+
+    def close(self):
+        pass
+
+class JSONLExportWriter:
+    def __init__(self, f, resumed):
+        self.f = f
+
+    def write(self, rows):
+        self.f.writelines(json.dumps(dict(zip(EXPORT_FIELDS, row))) + '\n' for row in rows)
+
+    def close(self):
+        pass
+
+class ParquetExportWriter:
+    # One row group per chunk.  Parquet files cannot be appended to, so there is no resuming.
+    SCHEMA_TYPES = {'id' : 'int64', 'value_num' : 'float64'}
+
+    def __init__(self, path):
+        self.schema = pyarrow.schema([(x, getattr(pyarrow, self.SCHEMA_TYPES.get(x, 'string'))()) for x in EXPORT_FIELDS])
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+
+    def write(self, rows):
+        columns = list(zip(*rows))
+        self.writer.write_table(pyarrow.Table.from_arrays([pyarrow.array(x, type=t) for x, t in zip(columns, self.schema.types)], schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+def load_state(path):
+    with open(path, 'r') as f:
+        return json.load(f)
+
+def save_state(path, state):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(state, f)
+    os.replace(path + '.tmp', path)
+
+def main():
+    parser = argparse.ArgumentParser(description='Export lab results from the patient database.')
+    parser.add_argument('-c', '--config', default='config.yaml', help='configuration file (default: config.yaml)')
+    parser.add_argument('-d', '--database', help='database file (default: database_path from the configuration)')
+    parser.add_argument('-o', '--output', default='-', help='output file (default: stdout)')
+    parser.add_argument('-f', '--format', choices=['csv', 'jsonl', 'parquet'], default=None, help='output format (default: from output extension, otherwise csv)')
+    parser.add_argument('--ur', action='append', help='only this patient, may be repeated')
+    parser.add_argument('--since', type=parse_date, help='only results collected on or after this date (YYYY-MM-DD)')
+    parser.add_argument('--until', type=parse_date, help='only results collected before this date (YYYY-MM-DD)')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE, help='rows fetched and written at a time (default: {})'.format(DEFAULT_CHUNK_SIZE))
+    parser.add_argument('--resume', action='store_true', help='continue an interrupted export into the same output file')
+    args = parser.parse_args()
+
+    output_format = args.format
+    if output_format is None:
+        extension = os.path.splitext(args.output.lower())[1]
+        output_format = {'.jsonl' : 'jsonl', '.parquet' : 'parquet'}.get(extension, 'csv')
+    if output_format == 'parquet':
+        if pyarrow is None:
+            parser.error('parquet output needs pyarrow, which is not installed')
+        if args.output == '-' or args.resume:
+            parser.error('parquet output must go to a file and cannot be resumed')
+    if args.resume and args.output == '-':
+        parser.error('--resume needs an output file')
+
+    database_path = args.database
+    if database_path is None:
+        # Read directly rather than through processing.Configuration, which would load the recognition stack
+        with open(args.config, 'r') as f:
+            database_path = yaml.safe_load(f)['main']['database_path']
+
+    # The filters are part of the state, so that a resumed export cannot silently change what it selects
+    state_path = args.output + STATE_EXTENSION
+    filters = {
+        'format' : output_format,
+        'ur' : args.ur,
+        'since' : args.since.strftime(DATE_FORMAT) if args.since else None,
+        'until' : args.until.strftime(DATE_FORMAT) if args.until else None,
+    }
+    state = {'filters' : filters, 'last_id' : 0, 'offset' : 0}
+    if args.resume:
+        if not os.path.exists(state_path) or not os.path.exists(args.output):
+            parser.error('nothing to resume: {} or {} is missing'.format(args.output, state_path))
+        state = load_state(state_path)
+        if state['filters'] != filters:
+            parser.error('the export being resumed used different options: {}'.format(state['filters']))
+
+    patient_db = PatientDatabase(database_path)
+    if output_format == 'parquet':
+        output_file = None
+        writer = ParquetExportWriter(args.output)
+    else:
+        if args.output == '-':
+            output_file = sys.stdout
+        elif args.resume:
+            output_file = open(args.output, 'r+', newline='', encoding='utf-8')
+            output_file.seek(state['offset'])
+            output_file.truncate()
+        else:
+            output_file = open(args.output, 'w', newline='', encoding='utf-8')
+        writer = (CSVExportWriter if output_format == 'csv' else JSONLExportWriter)(output_file, args.resume)
+
+    accept = collected_between(args.since, args.until)
+    exported = 0
+    try:
+        for rows in export_rows(args.chunk_size, args.ur, state['last_id']):
+            last_id = rows[-1][0]
+            if accept is not None:
+                rows = [x for x in rows if accept(x)]
+            if len(rows) > 0:
+                writer.write(rows)
+                exported += len(rows)
+            if output_file is not None and output_file is not sys.stdout:
+                output_file.flush()
+                state['last_id'] = last_id
+                state['offset'] = output_file.tell()
+                save_state(state_path, state)
+        writer.close()
+    finally:
+        if output_file is not None and output_file is not sys.stdout:
+            output_file.close()
+        patient_db.close()
+
+    print('Exported {} results.'.format(exported), file=sys.stderr)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
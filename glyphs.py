@@ -0,0 +1,342 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import sys, os, pickle, json, struct, hashlib, sqlite3, threading, argparse
+from collections import OrderedDict
+
+import numpy as np
+
+import auslab
+
+# Lines where the fraction of mismatched pixels in any one character exceeds this are handed back to the reference
+# recognizer, e.g. if the line image is not aligned to the character grid.  Checked per character rather than averaged
+# over the line, where the blank cells of a mostly empty line would hide a misaligned word.
+DEFAULT_MAX_MISMATCH = 0.1
+
+# Compiled template files: magic, little-endian uint32 header length, JSON header (char index and array layout),
+# then the bit-packed glyph arrays of each template set, each starting on an aligned offset
+COMPILED_TEMPLATE_EXTENSION = '.glyphs'
+COMPILED_TEMPLATE_MAGIC = b'ASGLYPH1'
+COMPILED_TEMPLATE_ALIGNMENT = 64
+
+DEFAULT_GLYPH_CACHE_SIZE = 8192
+# New glyphs are written to the on-disk cache in batches of this size, and on flush()
+GLYPH_CACHE_FLUSH_SIZE = 64
+
+def binarize(image):
+    # Templates are stored as 1 = background, 0 = glyph, so normalise line images to the same polarity
+    image = np.asarray(image)
+    threshold = (int(image.max()) + int(image.min())) / 2
+    binary = image > threshold
+    if binary.mean() < 0.5:
+        binary = ~binary
+    return binary
+
+def pack_cells(cells):
+    # (n, height, width) boolean cells -> (n, bytes) uint8
+    return np.packbits(cells.reshape(cells.shape[0], -1), axis=1)
+
+def cut_cells(binary_line, char_width):
+    height = binary_line.shape[0]
+    char_count = binary_line.shape[1] // char_width
+    cells = binary_line[:, :char_count * char_width].reshape(height, char_count, char_width)
+    return cells.transpose(1, 0, 2)
+
+class GlyphTemplates:
+    # All template variants for a single character width, stacked into one bit-packed array
+
+    def __init__(self, chars, glyphs, height, width):
+        self.chars = chars
+        self.glyphs = glyphs
+        self.height = height
+        self.width = width
+        self.char_array = np.array(chars)
+        self._matrix = None
+        self._glyph_sums = None
+        self._digest = None
+
+    def digest(self):
+        # Identifies this exact template set, so that cached recognitions are never reused after templates change
+        if self._digest is None:
+            h = hashlib.sha1(json.dumps([self.chars, self.height, self.width]).encode('utf-8'))
+            h.update(np.ascontiguousarray(self.glyphs).tobytes())
+            self._digest = h.digest()[:8]
+        return self._digest
+
+    def _unpack(self):
+        # Unpacked on first use so that opening a memory-mapped template file does not touch the glyph data
+        # Scoring is then a single matrix product: mismatches(a, t) = |a| + |t| - 2 a.t
+        self._matrix = np.unpackbits(self.glyphs, axis=1, count=self.height * self.width).astype(np.float32)
+        self._glyph_sums = self._matrix.sum(axis=1)
+
+    @staticmethod
+    def fromTemplateDict(templates):
+        chars = []
+        cells = []
+        for char in sorted(templates):
+            for variant in templates[char]:
+                chars.append(char)
+                cells.append(np.asarray(variant) > 0.5)
+        cells = np.stack(cells)
+        return GlyphTemplates(chars, pack_cells(cells), cells.shape[1], cells.shape[2])
+
+    def score(self, packed_cells):
+        # Returns (best template index, mismatched pixel count) for every bit-packed cell
+        if self._matrix is None:
+            self._unpack()
+        flat_cells = np.unpackbits(packed_cells, axis=1, count=self.height * self.width).astype(np.float32)
+        distances = flat_cells.sum(axis=1)[:, None] + self._glyph_sums[None, :] - 2 * (flat_cells @ self._matrix.T)
+        best_index = distances.argmin(axis=1)
+        return best_index, distances[np.arange(len(best_index)), best_index]
+
+class GlyphCache:
+    # Maps bit-packed cells (prefixed with their template set digest) to (char, mismatch) with a bounded LRU in memory,
+    # optionally persisted to an SQLite file so that later sessions start warm
+
+    def __init__(self, max_entries=DEFAULT_GLYPH_CACHE_SIZE, path=None):
+        self.max_entries = max_entries
+        self.path = path
+        self.entries = OrderedDict()
+        self.pending = []
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.db = None
+        if path:
+            self.db = sqlite3.connect(path, timeout=10, check_same_thread=False)
+            self.db.execute('CREATE TABLE IF NOT EXISTS glyphs (key BLOB PRIMARY KEY, char TEXT NOT NULL, mismatch INTEGER NOT NULL)')
+            with self.db:
+                self._prune()
+            rows = self.db.execute('SELECT key, char, mismatch FROM glyphs ORDER BY rowid DESC LIMIT ?', (max_entries,)).fetchall()
+            for key, char, mismatch in reversed(rows):
+                self.entries[key] = (char, mismatch)
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, char, mismatch):
+        with self.lock:
+            self.entries[key] = (char, mismatch)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            if self.db is not None:
+                self.pending.append((key, char, mismatch))
+                if len(self.pending) >= GLYPH_CACHE_FLUSH_SIZE:
+                    self._flush()
+
+    def _prune(self):
+        # Keeps the file to the max_entries most recently written glyphs, the ones a new session would load
+        self.db.execute('DELETE FROM glyphs WHERE rowid <= (SELECT rowid FROM glyphs ORDER BY rowid DESC LIMIT 1 OFFSET ?)', (self.max_entries,))
+
+    def _flush(self):
+        if self.db is not None and len(self.pending) > 0:
+            with self.db:
+                self.db.executemany('INSERT OR REPLACE INTO glyphs (key, char, mismatch) VALUES (?, ?, ?)', self.pending)
+                self._prune()
+            self.pending = []
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries' : len(self.entries),
+                'hits' : self.hits,
+                'misses' : self.misses,
+                'hit_rate' : self.hits / lookups if lookups > 0 else 0.0,
+            }
+
+def load_pickled_templates(template_file_path):
+    # Template files hold a list of two {char: [variant arrays]} dicts, for normal and condensed character widths
+    with open(template_file_path, 'rb') as f:
+        template_dicts = pickle.load(f)
+    return [GlyphTemplates.fromTemplateDict(x) for x in template_dicts]
+
+def file_digest(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+def save_compiled_templates(template_sets, compiled_path, source_digest=None):
+    header = {'source_sha1' : source_digest, 'sets' : []}
+    offset = 0
+    for template_set in template_sets:
+        header['sets'].append({
+            'chars' : template_set.chars,
+            'height' : template_set.height,
+            'width' : template_set.width,
+            'shape' : list(template_set.glyphs.shape),
+            'offset' : offset,
+        })
+        offset += template_set.glyphs.nbytes
+        offset += -offset % COMPILED_TEMPLATE_ALIGNMENT
+
+    header_bytes = json.dumps(header).encode('utf-8')
+    data_start = len(COMPILED_TEMPLATE_MAGIC) + 4 + len(header_bytes)
+    data_start += -data_start % COMPILED_TEMPLATE_ALIGNMENT
+
+    # Written to a temporary file and renamed so that readers never see a partially written file
+    temp_path = compiled_path + '.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(COMPILED_TEMPLATE_MAGIC)
+        f.write(struct.pack('<I', len(header_bytes)))
+        f.write(header_bytes)
+        for template_set, set_header in zip(template_sets, header['sets']):
+            f.write(b'\0' * (data_start + set_header['offset'] - f.tell()))
+            f.write(np.ascontiguousarray(template_set.glyphs, dtype=np.uint8).tobytes())
+    os.replace(temp_path, compiled_path)
+
+def read_compiled_header(compiled_path):
+    with open(compiled_path, 'rb') as f:
+        if f.read(len(COMPILED_TEMPLATE_MAGIC)) != COMPILED_TEMPLATE_MAGIC:
+            raise ValueError('{} is not a compiled template file'.format(compiled_path))
+        header_length, = struct.unpack('<I', f.read(4))
+        header = json.loads(f.read(header_length).decode('utf-8'))
+    data_start = len(COMPILED_TEMPLATE_MAGIC) + 4 + header_length
+    data_start += -data_start % COMPILED_TEMPLATE_ALIGNMENT
+    return header, data_start
+
+def load_compiled_templates(compiled_path):
+    header, data_start = read_compiled_header(compiled_path)
+
+    template_sets = []
+    for set_header in header['sets']:
+        glyphs = np.memmap(compiled_path, dtype=np.uint8, mode='r', offset=data_start + set_header['offset'], shape=tuple(set_header['shape']))
+        template_sets.append(GlyphTemplates(set_header['chars'], glyphs, set_header['height'], set_header['width']))
+    return template_sets
+
+def compiled_template_path(template_file_path):
+    return os.path.splitext(template_file_path)[0] + COMPILED_TEMPLATE_EXTENSION
+
+def compile_template_file(template_file_path, compiled_path=None):
+    if compiled_path is None:
+        compiled_path = compiled_template_path(template_file_path)
+    save_compiled_templates(load_pickled_templates(template_file_path), compiled_path, file_digest(template_file_path))
+    return compiled_path
+
+def load_template_file(template_file_path):
+    # Prefer the compiled, memory-mapped version of a pickled template file, unless it was compiled from a different pickle
+    if template_file_path.endswith(COMPILED_TEMPLATE_EXTENSION):
+        return load_compiled_templates(template_file_path)
+    compiled_path = compiled_template_path(template_file_path)
+    if os.path.exists(compiled_path):
+        header, data_start = read_compiled_header(compiled_path)
+        if not os.path.exists(template_file_path) or header['source_sha1'] == file_digest(template_file_path):
+            return load_compiled_templates(compiled_path)
+    return load_pickled_templates(template_file_path)
+
+class BatchTemplateRecognizer:
+
+    def __init__(self, config, glyph_cache=None):
+        self.config = config
+        self.template_sets = load_template_file(config['template_file_path'])
+        self.max_mismatch = config.get('batch_max_mismatch', DEFAULT_MAX_MISMATCH)
+        self.glyph_cache = glyph_cache
+        # The reference recognizer unpickles its own templates, so it is only created when a line needs it
+        self.fallback_recognizer = None
+        # Lines may be recognized on several threads at once, and the reference recognizer is not known to be thread safe
+        self.fallback_lock = threading.Lock()
+
+    def _fallbackRecognizeLine(self, raw_line):
+        with self.fallback_lock:
+            if self.fallback_recognizer is None:
+                self.fallback_recognizer = auslab.AuslabTemplateRecognizer(self.config)
+            return self.fallback_recognizer.recognizeLine(raw_line)
+
+    def warmUp(self):
+        for template_set in self.template_sets:
+            template_set._unpack()
+            template_set.digest()
+
+    def recognizeLine(self, raw_line):
+        return self.recognizeLines([raw_line])[0]
+
+    def _candidateSets(self, binary_line):
+        # Every template set that fits the line is tried, the one matching best is used
+        return [x for x in self.template_sets if x.height == binary_line.shape[0] and binary_line.shape[1] >= x.width]
+
+    def _resolveCells(self, line_candidates):
+        # Each distinct cell is resolved once: from the glyph cache where possible, otherwise all remaining cells of a
+        # template set are scored together in a single pass
+        resolved = {}
+        misses = {id(x) : OrderedDict() for x in self.template_sets}
+        for candidates in line_candidates:
+            for template_set, keys, packed_cells in candidates:
+                set_misses = misses[id(template_set)]
+                for key, packed_cell in zip(keys, packed_cells):
+                    if key in resolved or key in set_misses:
+                        continue
+                    cached = self.glyph_cache.get(key) if self.glyph_cache is not None else None
+                    if cached is None:
+                        set_misses[key] = packed_cell
+                    else:
+                        resolved[key] = cached
+
+        for template_set in self.template_sets:
+            set_misses = misses[id(template_set)]
+            if len(set_misses) == 0:
+                continue
+            best_index, best_distance = template_set.score(np.stack(list(set_misses.values())))
+            for key, index, distance in zip(set_misses, best_index, best_distance):
+                resolved[key] = (template_set.chars[index], int(distance))
+                if self.glyph_cache is not None:
+                    self.glyph_cache.put(key, template_set.chars[index], int(distance))
+        return resolved
+
+    def recognizeLines(self, raw_lines):
+        line_candidates = []
+        for raw_line in raw_lines:
+            binary_line = binarize(getattr(raw_line, 'line_image', raw_line))
+            candidates = []
+            for template_set in self._candidateSets(binary_line):
+                packed_cells = pack_cells(cut_cells(binary_line, template_set.width))
+                digest = template_set.digest()
+                keys = [digest + x.tobytes() for x in packed_cells]
+                candidates.append((template_set, keys, packed_cells))
+            line_candidates.append(candidates)
+
+        resolved = self._resolveCells(line_candidates)
+
+        lines = []
+        for raw_line, candidates in zip(raw_lines, line_candidates):
+            best_text = None
+            best_mismatch = None
+            worst_cell_mismatch = None
+            for template_set, keys, packed_cells in candidates:
+                cells = [resolved[x] for x in keys]
+                mismatch = sum(x[1] for x in cells) / (len(cells) * template_set.height * template_set.width)
+                if best_mismatch is None or mismatch < best_mismatch:
+                    best_mismatch = mismatch
+                    best_text = ''.join(x[0] for x in cells)
+                    worst_cell_mismatch = max(x[1] for x in cells) / (template_set.height * template_set.width)
+            if best_text is None or worst_cell_mismatch > self.max_mismatch:
+                best_text = self._fallbackRecognizeLine(raw_line)
+            lines.append(best_text)
+        return lines
+
+def main():
+    parser = argparse.ArgumentParser(description='Compile pickled templates-*.dat files into memory-mappable {} files.'.format(COMPILED_TEMPLATE_EXTENSION))
+    parser.add_argument('template_files', nargs='+', help='pickled template files to compile')
+    parser.add_argument('-o', '--output', default=None, help='output path (only valid with a single template file)')
+    args = parser.parse_args()
+
+    if args.output is not None and len(args.template_files) > 1:
+        parser.error('--output can only be used with a single template file')
+
+    for template_file_path in args.template_files:
+        compiled_path = compile_template_file(template_file_path, args.output)
+        print('{} -> {}'.format(template_file_path, compiled_path))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
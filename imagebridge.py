@@ -0,0 +1,53 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Views of QImage pixels as numpy arrays and of numpy arrays as QImages, sharing memory instead of copying frames.
+# A view is only valid while the image or array it was made from is alive and unchanged; QImage views keep a
+# reference to their source, numpy views of QImages do not, so callers must hold on to the QImage.
+
+import numpy as np
+
+from PyQt5 import sip
+from PyQt5.QtGui import QImage
+
+# All 0xAARRGGBB in memory, so one can be read as another without conversion (screenshots are opaque)
+RGB32_LAYOUT_FORMATS = (QImage.Format_RGB32, QImage.Format_ARGB32, QImage.Format_ARGB32_Premultiplied)
+
+def _keep_alive(view, source):
+    view._bridge_source = source
+    return view
+
+def as_rgb32(qimage):
+    # Reinterprets 32 bit images in place and converts anything else once
+    if qimage.format() == QImage.Format_RGB32:
+        return qimage
+    if qimage.format() in RGB32_LAYOUT_FORMATS:
+        view = QImage(sip.voidptr(int(qimage.constBits())), qimage.width(), qimage.height(), qimage.bytesPerLine(), QImage.Format_RGB32)
+        return _keep_alive(view, qimage)
+    return qimage.convertToFormat(QImage.Format_RGB32)
+
+def clip_rect(qimage, x, y, width, height):
+    # Returns (x, y, width, height) clipped to the image
+    x = max(0, min(x, qimage.width()))
+    y = max(0, min(y, qimage.height()))
+    return x, y, max(0, min(width, qimage.width() - x)), max(0, min(height, qimage.height() - y))
+
+def qimage_to_ndarray(qimage, rect=None):
+    # Read only (height, width, 4) uint8 view of a 32 bit image - B, G, R, A on little endian machines - optionally
+    # limited to rect (x, y, width, height).  Rows keep the image's stride, nothing is copied.
+    if qimage.depth() != 32:
+        raise ValueError('Only 32 bit images can be viewed as arrays, not format {}'.format(int(qimage.format())))
+    bits = qimage.constBits()
+    bits.setsize(qimage.bytesPerLine() * qimage.height())
+    array = np.ndarray((qimage.height(), qimage.width(), 4), np.uint8, buffer=bits, strides=(qimage.bytesPerLine(), 4, 1))
+    if rect is not None:
+        x, y, width, height = clip_rect(qimage, *rect)
+        array = array[y:y + height, x:x + width]
+    return array
+
+def ndarray_to_qimage(ndarray):
+    # Grayscale QImage over a 2D uint8 array, copied only if its pixels are not contiguous within rows
+    if ndarray.dtype != np.uint8 or ndarray.strides[1] != 1 or ndarray.strides[0] < ndarray.shape[1]:
+        ndarray = np.ascontiguousarray(ndarray, dtype=np.uint8)
+    qimage = QImage(sip.voidptr(ndarray.ctypes.data), ndarray.shape[1], ndarray.shape[0], ndarray.strides[0], QImage.Format_Grayscale8)
+    return _keep_alive(qimage, ndarray)
@@ -0,0 +1,218 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Retention and housekeeping for the patient database.  Lab groups past the retention limits are written to gzipped
+# JSON lines archives and then deleted, after which free pages are returned to the file system and the query planner
+# statistics refreshed.  Every step is a separate job on the database writer thread, so screenshots saved in the
+# meantime are written between steps rather than waiting for the whole run, and a run stops early once processing
+# resumes, to be picked up again by the next one.
+#
+# Databases created before incremental vacuuming was enabled keep their free pages until they are converted, which
+# takes a full VACUUM and so is only done on request, with Assist closed:
+#   python maintenance.py --enable-incremental-vacuum
+
+import sys, os, argparse, json, gzip, datetime, itertools, threading
+
+import yaml
+
+from peewee import chunked
+
+from database import PatientDatabase, Patient, LabTestGroup, LabTest, LabTestHistory, parse_collection_time
+from metrics import metrics
+
+# Lab groups archived and deleted per transaction
+MAINTENANCE_BATCH_SIZE = 50
+# Free pages released per incremental vacuum step
+VACUUM_PAGES_PER_STEP = 1000
+
+ARCHIVE_FILENAME_FORMAT = 'patients-%Y%m%d-%H%M%S.jsonl.gz'
+
+# PRAGMA auto_vacuum value for incremental vacuuming
+AUTO_VACUUM_INCREMENTAL = 2
+
+def expired_groups(retention_days, max_groups, now=None):
+    # Ids of the lab groups collected more than retention_days ago or older than the newest max_groups of their
+    # patient (0 disables either limit).  Groups whose collection time cannot be read never expire by age and count as
+    # the oldest of their patient.
+    cutoff = (now or datetime.datetime.now()) - datetime.timedelta(days=retention_days) if retention_days > 0 else None
+    query = (LabTestGroup
+        .select(LabTestGroup.patient, LabTestGroup.id, LabTestGroup.datetime)
+        .order_by(LabTestGroup.patient, LabTestGroup.id)
+        .tuples())
+    expired = []
+    for patient_id, groups in itertools.groupby(query.iterator(), key=lambda x: x[0]):
+        groups = [(parse_collection_time(collection_time), group_id) for _, group_id, collection_time in groups]
+        groups.sort(key=lambda x: (x[0] is not None, x[0] or datetime.datetime.min, x[1]), reverse=True)
+        for rank, (collected_at, group_id) in enumerate(groups):
+            if (max_groups > 0 and rank >= max_groups) or (cutoff is not None and collected_at is not None and collected_at < cutoff):
+                expired.append(group_id)
+    return expired
+
+def archive_records(group_ids):
+    # One record per lab group with its patient and results, from a single query
+    query = (LabTest
+        .select(LabTestGroup.id, Patient.UR, Patient.name, Patient.DOB, LabTestGroup.lab_number, LabTestGroup.datetime,
+            LabTest.name, LabTest.value, LabTest.auslab_color)
+        .join(LabTestGroup)
+        .join(Patient)
+        .where(LabTestGroup.id.in_(group_ids))
+        .order_by(LabTestGroup.id, LabTest.id)
+        .tuples())
+    records = {}
+    for group_id, UR, name, DOB, lab_number, collection_time, test_name, value, auslab_color in query:
+        if group_id not in records:
+            records[group_id] = {'UR' : UR, 'name' : name, 'DOB' : DOB, 'lab_number' : lab_number, 'collection_time' : collection_time, 'results' : []}
+        records[group_id]['results'].append([test_name, value, auslab_color])
+    # Groups without results are deleted all the same, so they are archived too
+    empty_group_ids = [x for x in group_ids if x not in records]
+    for group_id, UR, name, DOB, lab_number, collection_time in (LabTestGroup
+            .select(LabTestGroup.id, Patient.UR, Patient.name, Patient.DOB, LabTestGroup.lab_number, LabTestGroup.datetime)
+            .join(Patient)
+            .where(LabTestGroup.id.in_(empty_group_ids))
+            .tuples() if len(empty_group_ids) > 0 else []):
+        records[group_id] = {'UR' : UR, 'name' : name, 'DOB' : DOB, 'lab_number' : lab_number, 'collection_time' : collection_time, 'results' : []}
+    return [records[x] for x in group_ids if x in records]
+
+def delete_groups(db, group_ids):
+    # Removes the groups with their results and history entries in one transaction
+    with db.atomic():
+        for patient_id, lab_numbers in itertools.groupby(LabTestGroup
+                .select(LabTestGroup.patient, LabTestGroup.lab_number)
+                .where(LabTestGroup.id.in_(group_ids))
+                .order_by(LabTestGroup.patient)
+                .tuples(), key=lambda x: x[0]):
+            LabTestHistory.delete().where((LabTestHistory.patient == patient_id) & LabTestHistory.lab_number.in_([x[1] for x in lab_numbers])).execute()
+        LabTest.delete().where(LabTest.lab_test_group.in_(group_ids)).execute()
+        LabTestGroup.delete().where(LabTestGroup.id.in_(group_ids)).execute()
+
+class DatabaseMaintenance:
+
+    def __init__(self, patient_db, retention_days=0, max_groups=0, archive_directory=None, is_idle=None):
+        self.patient_db = patient_db
+        self.retention_days = retention_days
+        self.max_groups = max_groups
+        self.archive_directory = archive_directory
+        # Called before each step, the run stops if it returns False
+        self.is_idle = is_idle or (lambda: True)
+        self.running = False
+        self.running_lock = threading.Lock()
+
+    @staticmethod
+    def fromConfig(config, patient_db, is_idle=None):
+        return DatabaseMaintenance(patient_db,
+            config['main'].get('retention_days', 0),
+            config['main'].get('retention_max_groups', 0),
+            config['main'].get('archive_directory', './archive'),
+            is_idle)
+
+    def start(self):
+        # Queues a run unless one is already under way
+        with self.running_lock:
+            if self.running:
+                return
+            self.running = True
+        self._submit(self.findExpired)
+
+    def _submit(self, step, *args):
+        try:
+            self.patient_db.submit(self._step, step, *args)
+        except RuntimeError:
+            # The database is being closed, the rest of the run is left for next time
+            with self.running_lock:
+                self.running = False
+
+    def _step(self, step, *args):
+        # Runs on the database writer thread.  Each step returns the next (step, args) or None when the run is over
+        next_step = None
+        try:
+            if self.is_idle():
+                with metrics.span('database.maintenance'):
+                    next_step = step(*args)
+            else:
+                self.patient_db.log.emit('Database maintenance postponed while screenshots are processed')
+        finally:
+            if next_step is None:
+                with self.running_lock:
+                    self.running = False
+        if next_step is not None:
+            self._submit(*next_step)
+
+    def findExpired(self):
+        if self.retention_days <= 0 and self.max_groups <= 0:
+            return (self.compact,)
+        group_ids = expired_groups(self.retention_days, self.max_groups)
+        if len(group_ids) == 0:
+            return (self.compact,)
+        self.patient_db.log.emit('Archiving {} expired lab groups'.format(len(group_ids)))
+        archive_path = None
+        if self.archive_directory:
+            os.makedirs(self.archive_directory, exist_ok=True)
+            archive_path = os.path.join(self.archive_directory, datetime.datetime.now().strftime(ARCHIVE_FILENAME_FORMAT))
+        return (self.archiveBatch, list(chunked(group_ids, MAINTENANCE_BATCH_SIZE)), archive_path)
+
+    def archiveBatch(self, batches, archive_path):
+        group_ids = batches[0]
+        if archive_path is not None:
+            # Appended as another gzip member, which reads back as one stream.  The file is closed, and so complete on
+            # disk, before anything is deleted
+            with gzip.open(archive_path, 'at', encoding='utf-8') as f:
+                for record in archive_records(group_ids):
+                    f.write(json.dumps(record) + '\n')
+        delete_groups(self.patient_db.db, group_ids)
+        metrics.increment('lab_groups_archived', len(group_ids))
+        if len(batches) > 1:
+            return (self.archiveBatch, batches[1:], archive_path)
+        self.patient_db.log.emit('Expired lab groups archived{}'.format(' to {}'.format(archive_path) if archive_path else ''))
+        return (self.compact,)
+
+    def compact(self):
+        db = self.patient_db.db
+        if db.execute_sql('PRAGMA auto_vacuum').fetchone()[0] != AUTO_VACUUM_INCREMENTAL:
+            # Never converted here, the full VACUUM would hold up every save until it finished
+            return (self.analyze,)
+        if db.execute_sql('PRAGMA freelist_count').fetchone()[0] == 0:
+            return (self.analyze,)
+        db.execute_sql('PRAGMA incremental_vacuum({:d})'.format(VACUUM_PAGES_PER_STEP)).fetchall()
+        return (self.compact,)
+
+    def analyze(self):
+        # Updates planner statistics where SQLite thinks they are out of date
+        self.patient_db.db.execute_sql('PRAGMA optimize')
+        return None
+
+def enable_incremental_vacuum(patient_db):
+    # Rewrites the whole database file, so it must not be used by anything else meanwhile
+    db = patient_db.db
+    if db.execute_sql('PRAGMA auto_vacuum').fetchone()[0] == AUTO_VACUUM_INCREMENTAL:
+        return False
+    db.execute_sql('PRAGMA auto_vacuum = INCREMENTAL')
+    db.execute_sql('VACUUM')
+    return True
+
+def main():
+    parser = argparse.ArgumentParser(description='Maintenance of the patient database.  Run while Assist is closed.')
+    parser.add_argument('-c', '--config', default='config.yaml', help='configuration file (default: config.yaml)')
+    parser.add_argument('-d', '--database', help='database file (default: database_path from the configuration)')
+    parser.add_argument('--enable-incremental-vacuum', action='store_true', help='convert a database created by an older version, so that maintenance can release free space')
+    args = parser.parse_args()
+
+    if not args.enable_incremental_vacuum:
+        parser.error('nothing to do')
+
+    database_path = args.database
+    if database_path is None:
+        with open(args.config, 'r') as f:
+            database_path = yaml.safe_load(f)['main']['database_path']
+
+    patient_db = PatientDatabase(database_path)
+    try:
+        if enable_incremental_vacuum(patient_db):
+            print('Incremental vacuum enabled on {}.'.format(database_path), file=sys.stderr)
+        else:
+            print('Incremental vacuum was already enabled on {}.'.format(database_path), file=sys.stderr)
+    finally:
+        patient_db.close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
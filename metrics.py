@@ -0,0 +1,159 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# In-process timing spans, counters, gauges and histograms.  Spans are appended as JSON lines to a rotating file when
+# an export directory is configured, and the current totals can be written in the Prometheus text format, e.g. for the
+# node exporter's textfile collector.
+
+import os, re, json, time, logging, functools, threading
+from contextlib import contextmanager
+from logging.handlers import RotatingFileHandler
+
+# Upper bounds in milliseconds
+HISTOGRAM_BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, float('inf')]
+
+JSONL_FILENAME = 'metrics.jsonl'
+PROMETHEUS_FILENAME = 'metrics.prom'
+JSONL_MAX_BYTES = 10 * 1024 * 1024
+JSONL_BACKUP_COUNT = 5
+
+METRIC_PREFIX = 'assist_'
+
+class Histogram:
+
+    def __init__(self):
+        self.bucket_counts = [0] * len(HISTOGRAM_BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(HISTOGRAM_BUCKETS):
+            if value <= bound:
+                self.bucket_counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, fraction):
+        # Upper bound of the bucket holding the quantile
+        target = fraction * self.count
+        cumulative = 0
+        for bound, bucket_count in zip(HISTOGRAM_BUCKETS, self.bucket_counts):
+            cumulative += bucket_count
+            if cumulative >= target:
+                return min(bound, self.max)
+        return self.max
+
+class Metrics:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.event_logger = None
+        self.directory = None
+
+    def configure(self, directory):
+        # Starts writing span events and Prometheus totals to the directory, or stops if it is None
+        with self.lock:
+            if self.event_logger is not None:
+                for handler in list(self.event_logger.handlers):
+                    self.event_logger.removeHandler(handler)
+                    handler.close()
+                self.event_logger = None
+            self.directory = directory
+            if directory is None:
+                return
+            os.makedirs(directory, exist_ok=True)
+            handler = RotatingFileHandler(os.path.join(directory, JSONL_FILENAME), maxBytes=JSONL_MAX_BYTES, backupCount=JSONL_BACKUP_COUNT, encoding='utf-8')
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            self.event_logger = logging.getLogger('assist.metrics')
+            self.event_logger.propagate = False
+            self.event_logger.setLevel(logging.INFO)
+            self.event_logger.addHandler(handler)
+
+    def increment(self, name, count=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + count
+
+    def setGauge(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    def observe(self, name, milliseconds):
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            self.histograms[name].observe(milliseconds)
+            event_logger = self.event_logger
+        if event_logger is not None:
+            event_logger.info(json.dumps({'time' : time.time(), 'span' : name, 'ms' : round(milliseconds, 3), 'thread' : threading.current_thread().name}))
+
+    @contextmanager
+    def span(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, (time.perf_counter() - start) * 1000)
+
+    def timed(self, name, fn):
+        # fn wrapped in a span of the given name
+        @functools.wraps(fn)
+        def timed_fn(*args, **kwargs):
+            with self.span(name):
+                return fn(*args, **kwargs)
+        return timed_fn
+
+    def spanned(self, name):
+        # Decorator form of timed()
+        return lambda fn: self.timed(name, fn)
+
+    def summary(self):
+        # One line per span and a line of counters, for the debug log
+        with self.lock:
+            lines = ['{}: n={} mean {:.1f} ms, p95 <= {:.1f} ms, max {:.1f} ms'.format(name, h.count, h.sum / h.count, h.quantile(0.95), h.max)
+                for name, h in sorted(self.histograms.items()) if h.count > 0]
+            counters = dict(self.counters, **self.gauges)
+        if len(counters) > 0:
+            lines.append(', '.join('{} {}'.format(name, counters[name]) for name in sorted(counters)))
+        return lines
+
+    def prometheusText(self):
+        def metric_name(name):
+            return METRIC_PREFIX + re.sub(r'[^a-zA-Z0-9_]', '_', name)
+
+        lines = []
+        with self.lock:
+            for name, value in sorted(self.counters.items()):
+                lines.append('# TYPE {}_total counter'.format(metric_name(name)))
+                lines.append('{}_total {}'.format(metric_name(name), value))
+            for name, value in sorted(self.gauges.items()):
+                lines.append('# TYPE {} gauge'.format(metric_name(name)))
+                lines.append('{} {}'.format(metric_name(name), value))
+            for name, h in sorted(self.histograms.items()):
+                histogram_name = metric_name(name) + '_milliseconds'
+                lines.append('# TYPE {} histogram'.format(histogram_name))
+                cumulative = 0
+                for bound, bucket_count in zip(HISTOGRAM_BUCKETS, h.bucket_counts):
+                    cumulative += bucket_count
+                    lines.append('{}_bucket{{le="{}"}} {}'.format(histogram_name, '+Inf' if bound == float('inf') else bound, cumulative))
+                lines.append('{}_sum {}'.format(histogram_name, round(h.sum, 3)))
+                lines.append('{}_count {}'.format(histogram_name, h.count))
+        return '\n'.join(lines) + '\n'
+
+    def export(self):
+        # Rewrites the Prometheus file in one step, so a collector never reads half of it
+        directory = self.directory
+        if directory is None:
+            return
+        path = os.path.join(directory, PROMETHEUS_FILENAME)
+        with open(path + '.tmp', 'w') as f:
+            f.write(self.prometheusText())
+        os.replace(path + '.tmp', path)
+
+# Shared by every module of the application
+metrics = Metrics()
@@ -0,0 +1,113 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Versioned schema upgrades for the patient database.  The schema version is kept in SQLite's user_version pragma;
+# new databases are created from the current models at the latest version, existing ones are upgraded in place by
+# running every migration newer than their version, each in its own transaction.
+
+def get_schema_version(db):
+    return db.execute_sql('PRAGMA user_version').fetchone()[0]
+
+def set_schema_version(db, version):
+    db.execute_sql('PRAGMA user_version = {:d}'.format(version))
+
+def migration_1(db):
+    # Merge duplicate rows left by older versions, then add lookup indexes and the unique constraints used by upserts
+    db.execute_sql('''UPDATE labtestgroup SET patient_id = (
+        SELECT MIN(p2.id) FROM patient p1 JOIN patient p2 ON p2.UR = p1.UR WHERE p1.id = labtestgroup.patient_id)''')
+    db.execute_sql('DELETE FROM patient WHERE id NOT IN (SELECT MIN(id) FROM patient GROUP BY UR)')
+    db.execute_sql('''UPDATE labtest SET lab_test_group_id = (
+        SELECT MIN(g2.id) FROM labtestgroup g1 JOIN labtestgroup g2 ON g2.patient_id = g1.patient_id AND g2.lab_number = g1.lab_number
+        WHERE g1.id = labtest.lab_test_group_id)''')
+    db.execute_sql('DELETE FROM labtestgroup WHERE id NOT IN (SELECT MIN(id) FROM labtestgroup GROUP BY patient_id, lab_number)')
+    # The most recently written value of a test wins, as it did when it was overwritten
+    db.execute_sql('DELETE FROM labtest WHERE id NOT IN (SELECT MAX(id) FROM labtest GROUP BY lab_test_group_id, name)')
+
+    db.execute_sql('CREATE UNIQUE INDEX IF NOT EXISTS patient_UR ON patient (UR)')
+    db.execute_sql('CREATE INDEX IF NOT EXISTS labtestgroup_lab_number ON labtestgroup (lab_number)')
+    db.execute_sql('CREATE UNIQUE INDEX IF NOT EXISTS labtestgroup_patient_id_lab_number ON labtestgroup (patient_id, lab_number)')
+    db.execute_sql('CREATE INDEX IF NOT EXISTS labtest_name ON labtest (name)')
+    db.execute_sql('CREATE UNIQUE INDEX IF NOT EXISTS labtest_lab_test_group_id_name ON labtest (lab_test_group_id, name)')
+
+def migration_2(db):
+    # Per patient, per test history with a sortable collection time, filled from the results already stored
+    from database import parse_collection_time, INSERT_BATCH_SIZE
+
+    db.execute_sql('''CREATE TABLE IF NOT EXISTS "labtesthistory" (
+        "id" INTEGER NOT NULL PRIMARY KEY,
+        "patient_id" INTEGER NOT NULL,
+        "name" VARCHAR(255) NOT NULL,
+        "lab_number" VARCHAR(255) NOT NULL,
+        "collected_at" DATETIME,
+        "value" VARCHAR(255) NOT NULL,
+        "auslab_color" VARCHAR(255),
+        FOREIGN KEY ("patient_id") REFERENCES "patient" ("id"))''')
+    db.execute_sql('CREATE INDEX IF NOT EXISTS "labtesthistory_patient_id" ON "labtesthistory" ("patient_id")')
+    db.execute_sql('CREATE UNIQUE INDEX IF NOT EXISTS "labtesthistory_patient_id_name_lab_number" ON "labtesthistory" ("patient_id", "name", "lab_number")')
+    db.execute_sql('CREATE INDEX IF NOT EXISTS "labtesthistory_patient_id_name_collected_at" ON "labtesthistory" ("patient_id", "name", "collected_at")')
+
+    # Collection times are parsed here rather than in SQL, as AUSLAB writes months as names
+    cursor = db.execute_sql('''SELECT g.patient_id, t.name, g.lab_number, g.datetime, t.value, t.auslab_color
+        FROM labtest t JOIN labtestgroup g ON g.id = t.lab_test_group_id''')
+    while True:
+        rows = cursor.fetchmany(INSERT_BATCH_SIZE)
+        if len(rows) == 0:
+            break
+        db.cursor().executemany('''INSERT OR REPLACE INTO labtesthistory (patient_id, name, lab_number, collected_at, value, auslab_color)
+            VALUES (?, ?, ?, ?, ?, ?)''', [(patient_id, name, lab_number, _sqlite_datetime(parse_collection_time(collection_time)), value, auslab_color)
+                for patient_id, name, lab_number, collection_time, value, auslab_color in rows])
+
+def _sqlite_datetime(value):
+    # As peewee's DateTimeField stores it
+    return str(value) if value is not None else None
+
+def migration_3(db):
+    # Parsed numeric value, comparator and colour code beside each raw result
+    from database import typed_result_columns, INSERT_BATCH_SIZE
+
+    db.execute_sql('ALTER TABLE "labtest" ADD COLUMN "value_num" REAL')
+    db.execute_sql('ALTER TABLE "labtest" ADD COLUMN "comparator" VARCHAR(1)')
+    db.execute_sql('ALTER TABLE "labtest" ADD COLUMN "colour" SMALLINT')
+
+    cursor = db.execute_sql('SELECT id, value, auslab_color FROM labtest')
+    while True:
+        rows = cursor.fetchmany(INSERT_BATCH_SIZE)
+        if len(rows) == 0:
+            break
+        updates = []
+        for lab_test_id, value, auslab_color in rows:
+            columns = typed_result_columns(value, auslab_color)
+            updates.append((columns['value_num'], columns['comparator'], columns['colour'], lab_test_id))
+        db.cursor().executemany('UPDATE labtest SET value_num = ?, comparator = ?, colour = ? WHERE id = ?', updates)
+
+    db.execute_sql('CREATE INDEX IF NOT EXISTS "labtest_name_value_num" ON "labtest" ("name", "value_num")')
+
+# (version, description, function) in order - append new migrations here and never change released ones
+MIGRATIONS = [
+    (1, 'Add lookup indexes and unique constraints', migration_1),
+    (2, 'Add lab test history', migration_2),
+    (3, 'Add typed result columns', migration_3),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+def upgrade(db, models, log=None):
+    # Returns the list of migration versions applied.  Tables and indexes added to the models after a database was
+    # created must be created by a migration, never by create_tables(), so that they are added after any data fix-ups
+    if not db.table_exists(models[0]._meta.table_name):
+        db.create_tables(models)
+        set_schema_version(db, LATEST_VERSION)
+        return []
+
+    applied = []
+    version = get_schema_version(db)
+    for migration_version, description, migration in MIGRATIONS:
+        if migration_version <= version:
+            continue
+        if log is not None:
+            log('Upgrading database to version {}: {}'.format(migration_version, description))
+        with db.atomic():
+            migration(db)
+            set_schema_version(db, migration_version)
+        applied.append(migration_version)
+    return applied
@@ -0,0 +1,76 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import queue, threading
+
+DEFAULT_QUEUE_SIZE = 2
+
+class Stage:
+    # One step of a Pipeline.  fn takes an item and returns the item for the next stage, or None to drop it, and is
+    # called on the stage's own worker threads.
+
+    def __init__(self, name, fn, workers=1, queue_size=DEFAULT_QUEUE_SIZE):
+        self.name = name
+        self.fn = fn
+        self.workers = max(1, workers)
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.threads = []
+
+    @staticmethod
+    def fromConfig(name, fn, stage_config=None, queue_size=DEFAULT_QUEUE_SIZE):
+        stage_config = stage_config or {}
+        # Stage functions share in-memory images and recognizers, which cannot be handed to other processes
+        if stage_config.get('executor', 'thread') != 'thread':
+            raise ValueError('Pipeline stage {} can only run on threads, not executor {}'.format(name, stage_config['executor']))
+        return Stage(name, fn, stage_config.get('workers', 1), queue_size)
+
+class Pipeline:
+    # Stages connected by bounded queues, each with its own workers, so that consecutive items overlap - throughput is
+    # set by the slowest stage rather than the sum of all of them.  A full queue blocks the stage feeding it (and put())
+    # instead of buffering without limit.  Items can leave a stage with more than one worker out of order.
+
+    _STOP = object()
+
+    def __init__(self, stages, on_error=None):
+        self.stages = stages
+        self.on_error = on_error
+        self.started = False
+
+    def start(self):
+        for i, stage in enumerate(self.stages):
+            next_stage = self.stages[i + 1] if i + 1 < len(self.stages) else None
+            for n in range(stage.workers):
+                thread = threading.Thread(target=self._work, args=(stage, next_stage), name='Pipeline-{}-{}'.format(stage.name, n), daemon=True)
+                thread.start()
+                stage.threads.append(thread)
+        self.started = True
+
+    def put(self, item):
+        self.stages[0].queue.put(item)
+
+    def _work(self, stage, next_stage):
+        while True:
+            item = stage.queue.get()
+            if item is self._STOP:
+                return
+            try:
+                result = stage.fn(item)
+            except Exception as e:
+                result = None
+                if self.on_error is not None:
+                    self.on_error(stage.name, item, e)
+            if result is not None and next_stage is not None:
+                next_stage.queue.put(result)
+
+    def stop(self):
+        # Finishes every item already queued, one stage after another, then stops the workers
+        if not self.started:
+            return
+        for stage in self.stages:
+            for thread in stage.threads:
+                stage.queue.put(self._STOP)
+            for thread in stage.threads:
+                thread.join()
+            stage.threads = []
+        self.started = False
+
@@ -0,0 +1,135 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Cheap test of whether a clipboard image could be an AUSLAB screenshot.  Dimensions and a sparse sample of the mostly
+# black background reject almost everything else in microseconds, before the image is queued for processing.  The
+# remaining images must show one of the F1 function key buttons along the bottom of the screen, which takes tens of
+# milliseconds on large images and so is checked by the processing thread instead.
+
+import numpy as np
+
+from PyQt5.QtGui import QImage, qRed, qGreen, qBlue
+
+import imagebridge
+
+AUSLAB_MINIMUM_WIDTH = 1008
+AUSLAB_MINIMUM_HEIGHT = 730
+# Percentage of sampled pixels that must be black
+AUSLAB_MINIMUM_BLACK = 80
+
+AUSLAB_MINIMUM_WIDTH_LARGE = 1258
+AUSLAB_MINIMUM_HEIGHT_LARGE = 910
+
+# Pixels with no channel brighter than this count as black
+BLACK_LEVEL = 48
+SAMPLE_GRID_SIZE = 16
+
+HASH_SIZE = 8
+# Out of HASH_SIZE * HASH_SIZE bits
+F1_MAX_HASH_DISTANCE = 12
+# Only the windows closest in mean brightness to an F1 template are hashed
+F1_CANDIDATES = 256
+F1_SEARCH_STEP = 2
+
+def _grayscale(qimage, rect=None):
+    # The buttons are grey, so the green channel alone will do
+    if qimage.depth() != 32:
+        if rect is not None:
+            qimage = qimage.copy(*rect)
+            rect = None
+        qimage = qimage.convertToFormat(QImage.Format_RGB32)
+    return imagebridge.qimage_to_ndarray(qimage, rect)[:, :, 1].astype(np.float32)
+
+def _integral(gray):
+    integral = np.zeros((gray.shape[0] + 1, gray.shape[1] + 1), np.float64)
+    integral[1:, 1:] = gray.cumsum(axis=0).cumsum(axis=1)
+    return integral
+
+def _box_sums(integral, y0, x0, y1, x1):
+    return integral[y1, x1] - integral[y0, x1] - integral[y1, x0] + integral[y0, x0]
+
+def _average_hashes(integral, ys, xs, height, width):
+    # Average hash of the height x width windows at (ys[i], xs[i]): HASH_SIZE x HASH_SIZE block means compared with
+    # their overall mean.  Returns an (n, HASH_SIZE * HASH_SIZE) boolean array
+    y_edges = np.round(np.linspace(0, height, HASH_SIZE + 1)).astype(int)
+    x_edges = np.round(np.linspace(0, width, HASH_SIZE + 1)).astype(int)
+    y0 = (ys[:, None] + y_edges[None, :-1])[:, :, None]
+    y1 = (ys[:, None] + y_edges[None, 1:])[:, :, None]
+    x0 = (xs[:, None] + x_edges[None, :-1])[:, None, :]
+    x1 = (xs[:, None] + x_edges[None, 1:])[:, None, :]
+    means = _box_sums(integral, y0, x0, y1, x1) / (np.diff(y_edges)[:, None] * np.diff(x_edges)[None, :])
+    return (means > means.mean(axis=(1, 2), keepdims=True)).reshape(len(ys), -1)
+
+class F1Template:
+
+    def __init__(self, path):
+        qimage = QImage(path)
+        if qimage.isNull():
+            raise ValueError('Unable to load F1 template {}'.format(path))
+        gray = _grayscale(qimage)
+        self.height, self.width = gray.shape
+        self.mean = gray.mean()
+        self.hash = _average_hashes(_integral(gray), np.array([0]), np.array([0]), self.height, self.width)[0]
+
+    def distance(self, integral):
+        # Smallest hash distance of any window of the searched band
+        rows = np.arange(0, integral.shape[0] - self.height, F1_SEARCH_STEP)
+        columns = np.arange(0, integral.shape[1] - self.width, F1_SEARCH_STEP)
+        if len(rows) == 0 or len(columns) == 0:
+            return HASH_SIZE * HASH_SIZE
+        ys, xs = [x.ravel() for x in np.meshgrid(rows, columns, indexing='ij')]
+        means = _box_sums(integral, ys, xs, ys + self.height, xs + self.width) / (self.height * self.width)
+        distances = np.abs(means - self.mean)
+        nearest = np.argpartition(distances, F1_CANDIDATES)[:F1_CANDIDATES] if len(distances) > F1_CANDIDATES else np.arange(len(distances))
+        hashes = _average_hashes(integral, ys[nearest], xs[nearest], self.height, self.width)
+        return int((hashes != self.hash).sum(axis=1).min())
+
+class AuslabPreCheck:
+
+    def __init__(self, auslab_config):
+        # (minimum width, minimum height, search band height, F1 templates) per screen size
+        self.sizes = []
+        for name, minimum_width, minimum_height in [('normal', AUSLAB_MINIMUM_WIDTH, AUSLAB_MINIMUM_HEIGHT), ('large', AUSLAB_MINIMUM_WIDTH_LARGE, AUSLAB_MINIMUM_HEIGHT_LARGE)]:
+            size_config = auslab_config.get(name)
+            if size_config is None:
+                continue
+            templates = [F1Template(size_config[x]) for x in ['f1_normal_template_path', 'f1_condensed_template_path']]
+            # The buttons sit just above the bottom window border
+            band_height = size_config['screenshot_y_border_max'] + 3 * max(x.height for x in templates)
+            self.sizes.append((minimum_width, minimum_height, band_height, templates))
+
+    def _sizes(self, qimage):
+        return [x for x in self.sizes if qimage.width() >= x[0] and qimage.height() >= x[1]]
+
+    def check(self, qimage):
+        # Returns None for a plausible AUSLAB screenshot, otherwise the reason it was rejected
+        return self.checkBackground(qimage) or self.checkF1Button(qimage)
+
+    def checkBackground(self, qimage):
+        # The cheap part of check(), dimensions and background only
+        width, height = qimage.width(), qimage.height()
+        if len(self._sizes(qimage)) == 0:
+            return 'too small ({}x{})'.format(width, height)
+
+        ys = np.linspace(0, height - 1, SAMPLE_GRID_SIZE).astype(int)
+        xs = np.linspace(0, width - 1, SAMPLE_GRID_SIZE).astype(int)
+        if qimage.depth() == 32:
+            samples = imagebridge.qimage_to_ndarray(qimage)[ys[:, None], xs[None, :], :3]
+            black = (samples.max(axis=2) <= BLACK_LEVEL).sum()
+        else:
+            pixels = [qimage.pixel(x, y) for y in ys for x in xs]
+            black = sum(1 for x in pixels if max(qRed(x), qGreen(x), qBlue(x)) <= BLACK_LEVEL)
+        black_percentage = 100 * black / (SAMPLE_GRID_SIZE * SAMPLE_GRID_SIZE)
+        if black_percentage < AUSLAB_MINIMUM_BLACK:
+            return 'not enough black background ({:.0f}%)'.format(black_percentage)
+        return None
+
+    def checkF1Button(self, qimage):
+        # The expensive part of check(), searching the bottom of the image for an F1 button
+        width, height = qimage.width(), qimage.height()
+        for minimum_width, minimum_height, band_height, templates in self._sizes(qimage):
+            band_height = min(band_height, height)
+            integral = _integral(_grayscale(qimage, (0, height - band_height, width, band_height)))
+            if min(x.distance(integral) for x in templates) <= F1_MAX_HASH_DISTANCE:
+                return None
+        return 'no F1 button found'
@@ -0,0 +1,331 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import re, math, hashlib, threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import numpy as np
+
+import auslab
+
+import yaml
+
+import glyphs
+from metrics import metrics
+
+PATIENT_NAME_REGEX = re.compile(r'Name:\s+(.*)DOB:')
+PATIENT_UR_REGEX = re.compile(r'UR No:\s+[A-Z]{2,3}(\d{6})')
+PATIENT_DOB_REGEX = re.compile(r'DOB:\s+(\d{2}-\w{3}-\d{2})')
+LAB_NO_REGEX = re.compile(r'Lab No:\s+([0-9\-]+)')
+COLL_REGEX = re.compile(r'Coll:\s+(\d{2}:\d{2}\s+\d{2}-\w{3}-\d{2})')
+
+class Configuration:
+
+    instance = None
+
+    def __init__(self, config_filename):
+        self.config = yaml.safe_load(config_filename)
+
+    @staticmethod
+    def current():
+        if Configuration.instance is None:
+            Configuration.instance = Configuration(open('config.yaml', 'r'))
+        return Configuration.instance.config
+
+    @staticmethod
+    def load(config_path):
+        with open(config_path, 'r') as f:
+            Configuration.instance = Configuration(f)
+        return Configuration.instance.config
+
+class NotAuslabImageError(Exception):
+    pass
+
+# Letter escapes that stand for one character, a class or an assertion and take no argument
+SIMPLE_REGEX_ESCAPES = 'abfnrtvsSdDwWbBAZ'
+
+def regex_anchor(regex):
+    # Returns the longest run of literal characters that every match of the regex must contain, or None.  Groups,
+    # classes and escapes such as \\s end a run, a quantifier removes the character it applies to, and a top-level
+    # alternation means there is no single anchor.  Anything not understood here - escapes with arguments such as
+    # \\x48 or backreferences, inline flags such as (?x), lookarounds - also means no anchor, so the pattern is always
+    # searched
+    runs = []
+    current = ''
+    depth = 0
+    last_atom_literal = False
+    i = 0
+    while i < len(regex):
+        c = regex[i]
+        literal = None
+        if c == '\\':
+            escaped = regex[i + 1:i + 2]
+            if escaped.isalnum() and escaped not in SIMPLE_REGEX_ESCAPES:
+                return None
+            if escaped != '' and not escaped.isalnum():
+                literal = escaped
+            i += 2
+        elif c == '[':
+            i += 1
+            if regex[i:i + 1] == '^':
+                i += 1
+            if regex[i:i + 1] == ']':
+                i += 1
+            while i < len(regex) and regex[i] != ']':
+                i += 2 if regex[i] == '\\' else 1
+            i += 1
+        elif c == '(':
+            if regex[i + 1:i + 2] == '?' and regex[i + 2:i + 3] != ':' and regex[i + 2:i + 4] != 'P<':
+                return None
+            depth += 1
+            i += 1
+        elif c == ')':
+            depth -= 1
+            i += 1
+        elif c == '|' and depth == 0:
+            return None
+        elif c in '*+?' or (c == '{' and regex.find('}', i) != -1):
+            if last_atom_literal:
+                current = current[:-1]
+            if c == '{':
+                i = regex.index('}', i)
+            i += 1
+        elif c in '.^$|':
+            i += 1
+        else:
+            literal = c
+            i += 1
+
+        if literal is not None and depth == 0:
+            current += literal
+            last_atom_literal = True
+        else:
+            last_atom_literal = False
+            runs.append(current)
+            current = ''
+    runs.append(current)
+
+    anchor = max(runs, key=len)
+    return anchor if len(anchor) > 0 else None
+
+class TestExtractor:
+    # All configured match patterns, compiled once.  Each line is scanned a single time for the literal anchor words
+    # of the patterns ("Sodium", "Hgb", "PLT"...) and then only searched with the patterns whose anchor appears in it,
+    # so the cost per line stays flat as more tests are added to the configuration.
+
+    def __init__(self, match_patterns):
+        self.patterns = []
+        self.unanchored = []
+        anchored = {}
+        for index, mp in enumerate(match_patterns):
+            compiled = re.compile(mp['regex'])
+            self.patterns.append((mp['name'], compiled))
+            anchor = regex_anchor(mp['regex']) if not compiled.flags & re.IGNORECASE else None
+            if anchor is None:
+                self.unanchored.append(index)
+            else:
+                anchored.setdefault(anchor, []).append(index)
+
+        # The anchor scan only reports the longest anchor starting at each position, so every anchor also triggers
+        # the patterns of the anchors it contains
+        self.anchor_patterns = {}
+        for anchor in anchored:
+            self.anchor_patterns[anchor] = set(i for other, indices in anchored.items() if other in anchor for i in indices)
+
+        self.anchor_regex = None
+        if len(anchored) > 0:
+            alternatives = '|'.join(re.escape(x) for x in sorted(anchored, key=len, reverse=True))
+            self.anchor_regex = re.compile('(?=({}))'.format(alternatives))
+
+    @staticmethod
+    def fromConfig(config):
+        return TestExtractor(config['main']['match_patterns'])
+
+    def candidates(self, line):
+        indices = set(self.unanchored)
+        if self.anchor_regex is not None:
+            for anchor in set(x.group(1) for x in self.anchor_regex.finditer(line)):
+                indices.update(self.anchor_patterns[anchor])
+        return sorted(indices)
+
+    def matchLine(self, line):
+        # Returns (test name, value, span of the value) for every pattern matching the line, in configuration order
+        matches = []
+        for index in self.candidates(line):
+            name, compiled = self.patterns[index]
+            result = compiled.search(line)
+            if result is None:
+                continue
+            try:
+                matches.append((name, result.group('result'), result.span('result')))
+            except IndexError:
+                continue # pattern without a result group
+        return matches
+
+def load_auslab_image(qimage, auslab_config):
+    # qimage must be RGB32, see imagebridge.as_rgb32().  The AuslabImage reads its pixels without a reference to it,
+    # so the caller keeps qimage alive for as long as the AuslabImage is used
+    ai = auslab.AuslabImage(auslab_config)
+    ai.loadScreenshot(qimage)
+    return ai
+
+def get_size_config(ai, auslab_config):
+    # Returns the configuration section matching the detected screen size, which is also the recognizer configuration
+    if ai.size == ai.AUSLAB_SIZE_LARGE:
+        return auslab_config['large']
+    elif ai.size == ai.AUSLAB_SIZE_NORMAL:
+        return auslab_config['normal']
+    raise NotAuslabImageError('Unknown image size, cannot instantiate recognizer')
+
+# Glyph caches are shared by the recognizers of every screen size, keyed by their on-disk path
+_glyph_caches = {}
+
+def get_glyph_cache(config):
+    cache_size = config['main'].get('glyph_cache_size', glyphs.DEFAULT_GLYPH_CACHE_SIZE)
+    if cache_size <= 0:
+        return None
+    cache_path = config['main'].get('glyph_cache_path')
+    if cache_path not in _glyph_caches:
+        _glyph_caches[cache_path] = glyphs.GlyphCache(cache_size, cache_path)
+    return _glyph_caches[cache_path]
+
+def flush_glyph_caches():
+    for glyph_cache in _glyph_caches.values():
+        glyph_cache.flush()
+
+def create_recognizer(size_config, config):
+    if config['main'].get('batch_recognition', False):
+        return glyphs.BatchTemplateRecognizer(size_config, get_glyph_cache(config))
+    return auslab.AuslabTemplateRecognizer(size_config)
+
+def recognize_lines(recognizer, raw_lines, progress=None, step_offset=0, total_steps=None):
+    lines = []
+    for i, raw_line in enumerate(raw_lines):
+        lines.append(recognizer.recognizeLine(raw_line))
+        if progress is not None:
+            progress(step_offset + i + 1, total_steps)
+    return lines
+
+class RecognitionPool:
+    # Recognizes the lines of a screen concurrently on a thread pool, in one chunk of lines per worker.  The matrix
+    # products of batch recognition release the GIL, so the chunks are recognized in parallel.  Only batch recognizers
+    # are used here: the reference recognizer is not known to be thread safe and always runs serially.
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='LineRecognition')
+
+    @staticmethod
+    def fromConfig(config):
+        # None unless more than one recognition thread is configured
+        workers = config['main'].get('recognition_threads', 0)
+        return RecognitionPool(workers) if workers > 1 else None
+
+    def recognize(self, recognizer, raw_lines, progress=None, total_steps=None):
+        # Results are gathered in order and progress is reported as each chunk completes
+        raw_lines = list(raw_lines)
+        chunk_size = max(1, math.ceil(len(raw_lines) / self.workers))
+
+        futures = {}
+        for start in range(0, len(raw_lines), chunk_size):
+            futures[self.executor.submit(recognizer.recognizeLines, raw_lines[start:start + chunk_size])] = start
+
+        lines = [None] * len(raw_lines)
+        completed = 0
+        for future in as_completed(futures):
+            chunk_lines = future.result()
+            start = futures[future]
+            lines[start:start + len(chunk_lines)] = chunk_lines
+            completed += len(chunk_lines)
+            if progress is not None:
+                progress(completed, total_steps)
+        return lines
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+def recognize_all(recognizer, raw_lines, progress=None, total_steps=None, pool=None):
+    # Recognizes all lines in one call if the recognizer supports batches, otherwise line by line
+    metrics.increment('lines_recognized', len(raw_lines))
+    with metrics.span('recognition.{}'.format(type(recognizer).__name__)):
+        return _recognize_all(recognizer, raw_lines, progress, total_steps, pool)
+
+def _recognize_all(recognizer, raw_lines, progress, total_steps, pool):
+    if hasattr(recognizer, 'recognizeLines'):
+        if pool is not None and len(raw_lines) > 1:
+            return pool.recognize(recognizer, raw_lines, progress, total_steps)
+        lines = recognizer.recognizeLines(list(raw_lines))
+        if progress is not None:
+            progress(len(lines), total_steps)
+        return lines
+    return recognize_lines(recognizer, raw_lines, progress, 0, total_steps)
+
+def recognize_screen(recognizer, raw_header_lines, raw_center_lines, progress=None, total_steps=None, pool=None):
+    # Returns (header lines, center lines)
+    lines = recognize_all(recognizer, list(raw_header_lines) + list(raw_center_lines), progress, total_steps, pool)
+    return lines[:len(raw_header_lines)], lines[len(raw_header_lines):]
+
+def line_fingerprint(raw_line):
+    line_image = np.ascontiguousarray(getattr(raw_line, 'line_image', raw_line))
+    h = hashlib.blake2b(line_image.tobytes(), digest_size=16)
+    h.update(repr(line_image.shape).encode('ascii'))
+    return h.digest()
+
+class IncrementalScreenRecognizer:
+    # Remembers the text of every line band of the previous screenshot, so that only bands that have changed are
+    # recognized again.  Bands are matched by fingerprint wherever they are on screen, which also covers scrolling
+    # and paging, and an unchanged header (same UR and lab number) is never recognized twice.
+
+    def __init__(self):
+        self.recognizer = None
+        self.previous_lines = {}
+        self.reused_count = 0
+        self.lock = threading.Lock()
+
+    def recognize(self, recognizer, raw_header_lines, raw_center_lines, progress=None, total_steps=None, pool=None):
+        raw_lines = list(raw_header_lines) + list(raw_center_lines)
+        fingerprints = [line_fingerprint(x) for x in raw_lines]
+
+        # Screenshots may be recognized concurrently, so the previous lines are only locked while being read or replaced
+        with self.lock:
+            if recognizer is not self.recognizer:
+                # Different screen size or reloaded templates
+                self.recognizer = recognizer
+                self.previous_lines = {}
+            previous_lines = self.previous_lines
+
+        changed = [i for i, x in enumerate(fingerprints) if x not in previous_lines]
+
+        changed_lines = recognize_all(recognizer, [raw_lines[i] for i in changed], progress, total_steps, pool)
+        recognized = dict(zip(changed, changed_lines))
+        lines = [recognized[i] if i in recognized else previous_lines[x] for i, x in enumerate(fingerprints)]
+
+        with self.lock:
+            self.reused_count = len(raw_lines) - len(changed)
+            if recognizer is self.recognizer:
+                self.previous_lines = dict(zip(fingerprints, lines))
+        return lines[:len(raw_header_lines)], lines[len(raw_header_lines):]
+
+def parse_header(header_lines):
+    try:
+        return {
+            'UR' : PATIENT_UR_REGEX.search(header_lines[0]).group(1),
+            'name' : PATIENT_NAME_REGEX.search(header_lines[1]).group(1),
+            'DOB' : PATIENT_DOB_REGEX.search(header_lines[1]).group(1),
+            'collection_time' : COLL_REGEX.search(header_lines[0]).group(1),
+            'lab_number' : LAB_NO_REGEX.search(header_lines[0]).group(1),
+        }
+    except (AttributeError, IndexError):
+        raise NotAuslabImageError('Unable to read patient details from AUSLAB header')
+
+def extract_test_results(center_lines, extractor, line_char_color):
+    # Returns a list of (test name, value, AUSLAB colour) tuples in screen order
+    results = []
+    for i, line in enumerate(center_lines):
+        for name, value, span in extractor.matchLine(line):
+            try:
+                color = line_char_color(i, span[0])
+            except IndexError:
+                continue # value outside the recognized character cells, only this test is skipped
+            results.append((name, value, color))
+    return results
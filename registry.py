@@ -0,0 +1,147 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import os, json, hashlib, threading
+
+from PyQt5.QtCore import QObject, QFileSystemWatcher, QTimer, pyqtSignal
+
+import yaml
+
+import glyphs
+import processing
+
+def recognition_fingerprint(config):
+    # Digest of everything that decides what is recognized and extracted from a screenshot: the screen size settings,
+    # the contents of their template files and the match patterns
+    h = hashlib.sha1()
+    h.update(json.dumps([config['auslab'], config['main'].get('match_patterns'), config['main'].get('batch_recognition', False)], sort_keys=True, default=str).encode('utf-8'))
+    for size_config in config['auslab'].values():
+        template_file_path = size_config.get('template_file_path')
+        if template_file_path is not None and os.path.exists(template_file_path):
+            h.update(glyphs.file_digest(template_file_path).encode('ascii'))
+    return h.hexdigest()
+
+class RecognizerRegistry(QObject):
+    # Holds one long-lived recognizer per AUSLAB screen size, rebuilding them in the background when the
+    # configuration or template files change and swapping the whole set in at once
+    log = pyqtSignal(str)
+    loaded = pyqtSignal()
+
+    RELOAD_DELAY_MS = 500
+
+    def __init__(self, config_path='config.yaml'):
+        super().__init__()
+        self.config_path = config_path
+        self.config = None
+        self.recognizers = {}
+        self.fingerprint = None
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+        self.reload_thread = None
+
+        self.watcher = QFileSystemWatcher(self)
+        self.watcher.fileChanged.connect(self.handleFileChanged)
+        # The watcher belongs to the thread that created the registry, so files are only watched from there
+        self.loaded.connect(self.handleLoaded)
+
+        # Editors often write files in several steps, so reloads are deferred until changes settle
+        self.reload_timer = QTimer(self)
+        self.reload_timer.setSingleShot(True)
+        self.reload_timer.setInterval(self.RELOAD_DELAY_MS)
+        self.reload_timer.timeout.connect(self.reload)
+
+    def warmUp(self):
+        self.reload()
+
+    def reload(self):
+        if self.reload_thread is not None and self.reload_thread.is_alive():
+            # Try again once the current reload has finished
+            self.reload_timer.start()
+            return
+        self.reload_thread = threading.Thread(target=self._reload, name='RecognizerRegistryReload', daemon=True)
+        self.reload_thread.start()
+
+    def _reload(self):
+        try:
+            with open(self.config_path, 'r') as f:
+                config = yaml.safe_load(f)
+            size_configs = list(config['auslab'].values())
+        except Exception as e:
+            self.log.emit('Unable to load recognizers, keeping previous templates: {}'.format(e))
+            if self.config is None:
+                # Nothing to fall back to - let waiting callers fail rather than block forever
+                self.ready.set()
+            return
+
+        # Each screen size is loaded on its own, so missing templates for one size do not stop the others
+        recognizers = {}
+        for size_config in size_configs:
+            try:
+                recognizer = processing.create_recognizer(size_config, config)
+                if hasattr(recognizer, 'warmUp'):
+                    recognizer.warmUp()
+            except Exception as e:
+                with self.lock:
+                    previous = self.recognizers.get(size_config.get('name'))
+                if previous is not None:
+                    self.log.emit('Unable to load {} recognizer, keeping previous templates: {}'.format(size_config.get('name'), e))
+                    recognizers[size_config['name']] = previous
+                else:
+                    self.log.emit('Unable to load {} recognizer: {}'.format(size_config.get('name'), e))
+                continue
+            recognizers[size_config['name']] = recognizer
+
+        fingerprint = recognition_fingerprint(config)
+        with self.lock:
+            self.config = config
+            self.recognizers = recognizers
+            self.fingerprint = fingerprint
+        self.ready.set()
+        self.log.emit('Recognizers loaded: {}'.format(', '.join(sorted(recognizers)) or 'none'))
+        self.loaded.emit()
+
+    def handleLoaded(self):
+        with self.lock:
+            config = self.config
+        paths = [self.config_path]
+        for size_config in config['auslab'].values():
+            template_file_path = size_config['template_file_path']
+            paths.append(template_file_path)
+            paths.append(glyphs.compiled_template_path(template_file_path))
+        # Files replaced rather than rewritten drop out of the watcher, so they are re-added after every reload
+        paths = [x for x in paths if os.path.exists(x) and x not in self.watcher.files()]
+        if len(paths) > 0:
+            self.watcher.addPaths(paths)
+
+    def handleFileChanged(self, path):
+        self.log.emit('{} changed, reloading recognizers...'.format(path))
+        self.reload_timer.start()
+
+    def _waitUntilLoaded(self):
+        self.ready.wait()
+        if self.config is None:
+            raise RuntimeError('Recognizers could not be loaded from {}'.format(self.config_path))
+
+    def auslabConfig(self):
+        self._waitUntilLoaded()
+        with self.lock:
+            return self.config['auslab']
+
+    def matchPatterns(self):
+        self._waitUntilLoaded()
+        with self.lock:
+            return self.config['main']['match_patterns']
+
+    def recognitionFingerprint(self):
+        # Identifies the loaded templates and extraction configuration, e.g. for keying cached results
+        self._waitUntilLoaded()
+        with self.lock:
+            return self.fingerprint
+
+    def get(self, size_name):
+        self._waitUntilLoaded()
+        with self.lock:
+            recognizer = self.recognizers.get(size_name)
+        if recognizer is None:
+            raise processing.NotAuslabImageError('No recognizer for the {} screen size, its templates could not be loaded'.format(size_name))
+        return recognizer
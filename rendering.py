@@ -0,0 +1,115 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import re, codecs, string
+
+# START EXCERPT - From https://stackoverflow.com/questions/4020539/process-escape-sequences-in-a-string-in-python
+ESCAPE_SEQUENCE_RE = re.compile(r'''
+    ( \\U........      # 8-digit hex escapes
+    | \\u....          # 4-digit hex escapes
+    | \\x..            # 2-digit hex escapes
+    | \\[0-7]{1,3}     # Octal escapes
+    | \\N\{[^}]+\}     # Unicode characters by name
+    | \\[\\'"abfnrtv]  # Single-character escapes
+    )''', re.UNICODE | re.VERBOSE)
+
+def decode_escapes(s):
+    def decode_match(match):
+        return codecs.decode(match.group(0), 'unicode-escape')
+
+    return ESCAPE_SEQUENCE_RE.sub(decode_match, s)
+# END EXCERPT
+
+# This has to be the world's shittiest RTF colour substitution code
+# Decision: Let the format string determine the colour table, with a predefined/convention index correspondence between colour names and entries, as this allows for customisation:
+RTF_COLOUR_TABLE = {
+    "green" : 1,
+    "yellow" : 2,
+    "red" : 3,
+    "orange" : 4,
+    "blue" : 5,
+}
+
+MISSING_VALUE = '-'
+TREND_SEPARATOR = ', '
+
+# {name.prev} is the result before the current one, {name.trendN} the last N results, oldest first
+HISTORY_ATTRIBUTE_RE = re.compile(r'^(?:(?P<prev>prev)|trend(?P<trend>\d+))$')
+
+class OutputRenderer:
+    # An output string compiled once: escape sequences decoded and the referenced fields listed, so that rendering is
+    # a single str.format() over results already in memory.  History placeholders are rewritten to plain fields, and
+    # history_depth says how many earlier results of history_names render() needs.
+
+    def __init__(self, name, output_mime_type, format_string, non_green_bolding=False):
+        self.name = name
+        self.output_mime_type = output_mime_type
+        self.non_green_bolding = non_green_bolding
+        # format key -> (test name, 'prev', 'trend' or None for the current result, number of earlier results)
+        self.fields = {}
+        self.history_names = set()
+        self.history_depth = 0
+
+        template = []
+        keys = {}
+        for literal_text, field_name, format_spec, conversion in string.Formatter().parse(decode_escapes(format_string)):
+            template.append(literal_text.replace('{', '{{').replace('}', '}}'))
+            if field_name is None:
+                continue
+            if field_name not in keys:
+                keys[field_name] = 'f{}'.format(len(keys))
+                self.fields[keys[field_name]] = self._parseField(field_name)
+            template.append('{' + keys[field_name] + ('!' + conversion if conversion else '') + (':' + format_spec if format_spec else '') + '}')
+        self.template = ''.join(template)
+
+    def _parseField(self, field_name):
+        test_name, _, attribute = field_name.partition('.')
+        if attribute == '':
+            return (test_name, None, 0)
+        match = HISTORY_ATTRIBUTE_RE.match(attribute)
+        if match is None or (match.group('trend') and int(match.group('trend')) < 1):
+            raise ValueError('Unknown placeholder {{{}}} in output string {}'.format(field_name, self.name))
+        if match.group('prev'):
+            kind, depth = 'prev', 1
+        else:
+            kind, depth = 'trend', int(match.group('trend')) - 1
+        self.history_names.add(test_name)
+        self.history_depth = max(self.history_depth, depth)
+        return (test_name, kind, depth)
+
+    @staticmethod
+    def fromConfig(entry, non_green_bolding=False):
+        return OutputRenderer(entry['name'], entry['type'], entry['string'], non_green_bolding)
+
+    def formatValue(self, value, auslab_color):
+        if self.output_mime_type != 'application/rtf':
+            # Life is easy, assume text/plain, simply replace the values
+            return value
+        # "green" values in AUSLAB are normal and are rendered with the first colour table entry
+        colour_index = RTF_COLOUR_TABLE.get(auslab_color or 'green', RTF_COLOUR_TABLE['green'])
+        if self.non_green_bolding and auslab_color != 'green':
+            return '{{\\b\\cf{} {}}}'.format(colour_index, value)
+        return '{{\\cf{} {}}}'.format(colour_index, value)
+
+    def render(self, lab_results, history=None):
+        # lab_results is {test name: (value, AUSLAB colour)}, as returned by Patient.get_lab_results(), and history is
+        # {test name: [(value, AUSLAB colour), ...]} most recent first, as returned by Patient.get_test_history()
+        if len(lab_results) == 0:
+            return ''
+        history = history or {}
+        format_results = {}
+        for key, (test_name, kind, depth) in self.fields.items():
+            current = [lab_results[test_name]] if test_name in lab_results else []
+            if kind is None:
+                results = current
+            elif kind == 'prev':
+                results = history.get(test_name, [])[:1]
+            else:
+                results = list(reversed(history.get(test_name, [])[:depth])) + current
+            format_results[key] = TREND_SEPARATOR.join(self.formatValue(*x) for x in results) if len(results) > 0 else MISSING_VALUE
+        return self.template.format(**format_results)
+
+def compile_output_strings(config):
+    # Returns {output string name: OutputRenderer} for every configured output string
+    non_green_bolding = config['main']['non_green_bolding']
+    return {x['name'] : OutputRenderer.fromConfig(x, non_green_bolding) for x in config['main']['output_strings']}
@@ -0,0 +1,79 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import os, time, json, hashlib, sqlite3, threading
+
+DEFAULT_RESULT_CACHE_SIZE_MB = 32
+RESULT_CACHE_FILENAME = 'results-cache.sqlite3'
+
+def image_digest(qimage, fingerprint=''):
+    # Hashes the raw pixel buffer in place, without converting or copying the image first.  The fingerprint identifies
+    # the templates and configuration the results were produced with, so changing them misses the earlier entries
+    bits = qimage.constBits()
+    bits.setsize(qimage.bytesPerLine() * qimage.height())
+    h = hashlib.blake2b(digest_size=20)
+    h.update(fingerprint.encode('utf-8'))
+    h.update('{}x{}:{}:{}'.format(qimage.width(), qimage.height(), int(qimage.format()), qimage.bytesPerLine()).encode('ascii'))
+    h.update(bits)
+    return h.digest()
+
+def default_cache_path(database_path):
+    return os.path.join(os.path.dirname(os.path.abspath(database_path)), RESULT_CACHE_FILENAME)
+
+class ResultCache:
+    # Recognized lines, extracted results and the patient header of whole screenshots, keyed by image content and
+    # evicted least recently used first once the stored data exceeds max_bytes
+
+    def __init__(self, path, max_bytes=DEFAULT_RESULT_CACHE_SIZE_MB * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        with self.db:
+            self.db.execute('''CREATE TABLE IF NOT EXISTS screenshots (
+                key BLOB PRIMARY KEY,
+                data TEXT NOT NULL,
+                data_size INTEGER NOT NULL,
+                last_used REAL NOT NULL)''')
+            self.db.execute('CREATE INDEX IF NOT EXISTS screenshots_last_used ON screenshots (last_used)')
+
+    def get(self, key):
+        with self.lock:
+            row = self.db.execute('SELECT data FROM screenshots WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            with self.db:
+                self.db.execute('UPDATE screenshots SET last_used = ? WHERE key = ?', (time.time(), key))
+        data = json.loads(row[0])
+        data['results'] = [tuple(x) for x in data['results']]
+        return data
+
+    def put(self, key, header, header_lines, center_lines, results):
+        data = json.dumps({
+            'header' : header,
+            'header_lines' : header_lines,
+            'center_lines' : center_lines,
+            'results' : results,
+        })
+        with self.lock:
+            with self.db:
+                self.db.execute('INSERT OR REPLACE INTO screenshots (key, data, data_size, last_used) VALUES (?, ?, ?, ?)', (key, data, len(data), time.time()))
+                self._evict()
+
+    def _evict(self):
+        total_size, = self.db.execute('SELECT COALESCE(SUM(data_size), 0) FROM screenshots').fetchone()
+        if total_size <= self.max_bytes:
+            return
+        excess = total_size - self.max_bytes
+        evicted = 0
+        keys = []
+        for key, data_size in self.db.execute('SELECT key, data_size FROM screenshots ORDER BY last_used'):
+            if evicted >= excess:
+                break
+            keys.append((key,))
+            evicted += data_size
+        self.db.executemany('DELETE FROM screenshots WHERE key = ?', keys)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,109 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import os, sys, sqlite3, datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+import migrations
+from database import PatientDatabase, Patient, LabTestGroup, LabTest, LabTestHistory
+
+# The tables as created by versions before schema migrations, without any unique constraints
+BASELINE_SCHEMA = '''
+CREATE TABLE "patient" ("id" INTEGER NOT NULL PRIMARY KEY, "UR" VARCHAR(255) NOT NULL, "name" VARCHAR(255) NOT NULL, "DOB" VARCHAR(255) NOT NULL);
+CREATE TABLE "labtestgroup" ("id" INTEGER NOT NULL PRIMARY KEY, "patient_id" INTEGER NOT NULL, "lab_number" VARCHAR(255) NOT NULL, "datetime" VARCHAR(255) NOT NULL,
+    FOREIGN KEY ("patient_id") REFERENCES "patient" ("id"));
+CREATE INDEX "labtestgroup_patient_id" ON "labtestgroup" ("patient_id");
+CREATE TABLE "labtest" ("id" INTEGER NOT NULL PRIMARY KEY, "lab_test_group_id" INTEGER NOT NULL, "name" VARCHAR(255) NOT NULL, "value" VARCHAR(255) NOT NULL, "auslab_color" VARCHAR(255),
+    FOREIGN KEY ("lab_test_group_id") REFERENCES "labtestgroup" ("id"));
+CREATE INDEX "labtest_lab_test_group_id" ON "labtest" ("lab_test_group_id");
+'''
+
+# Patient 402710 was added twice, and lab number 20681-82411 saved under both copies
+BASELINE_ROWS = '''
+INSERT INTO patient VALUES (1, '402710', 'HOGAN JOSHUA LUKE', '07-Mar-19');
+INSERT INTO patient VALUES (2, '402710', 'HOGAN JOSHUA LUKE', '07-Mar-19');
+INSERT INTO patient VALUES (3, '123456', 'SMITH JANE', '01-Jan-50');
+INSERT INTO labtestgroup VALUES (1, 1, '20681-82411', '16:45 30-Aug-19');
+INSERT INTO labtestgroup VALUES (2, 2, '20681-82411', '16:45 30-Aug-19');
+INSERT INTO labtestgroup VALUES (3, 2, '20681-90000', '09:00 01-Sep-19');
+INSERT INTO labtestgroup VALUES (4, 3, '20681-12345', 'unreadable');
+INSERT INTO labtest VALUES (1, 1, 'sodium', '138', 'green');
+INSERT INTO labtest VALUES (2, 2, 'sodium', '140', 'yellow');
+INSERT INTO labtest VALUES (3, 2, 'potassium', '4.6', 'green');
+INSERT INTO labtest VALUES (4, 3, 'sodium', '>150', 'red');
+INSERT INTO labtest VALUES (5, 4, 'egfr', '>90', 'green');
+'''
+
+@pytest.fixture
+def baseline_db(tmp_path):
+    db_path = str(tmp_path / 'baseline.db')
+    connection = sqlite3.connect(db_path)
+    connection.executescript(BASELINE_SCHEMA + BASELINE_ROWS)
+    connection.close()
+    patient_db = PatientDatabase(db_path)
+    yield patient_db
+    patient_db.close()
+
+def lab_tests(patient):
+    # {lab number: {test name: (value, AUSLAB colour, value_num, comparator, colour)}}
+    query = (LabTest
+        .select(LabTestGroup.lab_number, LabTest.name, LabTest.value, LabTest.auslab_color, LabTest.value_num, LabTest.comparator, LabTest.colour)
+        .join(LabTestGroup)
+        .where(LabTestGroup.patient == patient)
+        .tuples())
+    tests = {}
+    for lab_number, name, *columns in query:
+        tests.setdefault(lab_number, {})[name] = tuple(columns)
+    return tests
+
+def test_new_database_is_at_latest_version(tmp_path):
+    patient_db = PatientDatabase(str(tmp_path / 'new.db'))
+    try:
+        assert migrations.get_schema_version(patient_db.db) == migrations.LATEST_VERSION
+    finally:
+        patient_db.close()
+
+def test_upgrade_merges_duplicates(baseline_db):
+    assert migrations.get_schema_version(baseline_db.db) == 3
+    assert sorted(Patient.select(Patient.id, Patient.UR).tuples()) == [(1, '402710'), (3, '123456')]
+    assert sorted(LabTestGroup.select(LabTestGroup.id, LabTestGroup.patient, LabTestGroup.lab_number).tuples()) == [
+        (1, 1, '20681-82411'), (3, 1, '20681-90000'), (4, 3, '20681-12345')]
+    # The most recently written value of a duplicated test is kept
+    assert lab_tests(Patient.get_by_id(1)) == {
+        '20681-82411' : {'sodium' : ('140', 'yellow', 140.0, None, 2), 'potassium' : ('4.6', 'green', 4.6, None, 1)},
+        '20681-90000' : {'sodium' : ('>150', 'red', 150.0, '>', 3)},
+    }
+    assert lab_tests(Patient.get_by_id(3)) == {'20681-12345' : {'egfr' : ('>90', 'green', 90.0, '>', 1)}}
+
+def test_upgrade_backfills_history(baseline_db):
+    history = sorted(LabTestHistory
+        .select(LabTestHistory.patient, LabTestHistory.name, LabTestHistory.lab_number, LabTestHistory.collected_at, LabTestHistory.value, LabTestHistory.auslab_color)
+        .tuples())
+    assert history == [
+        (1, 'potassium', '20681-82411', datetime.datetime(2019, 8, 30, 16, 45), '4.6', 'green'),
+        (1, 'sodium', '20681-82411', datetime.datetime(2019, 8, 30, 16, 45), '140', 'yellow'),
+        (1, 'sodium', '20681-90000', datetime.datetime(2019, 9, 1, 9, 0), '>150', 'red'),
+        (3, 'egfr', '20681-12345', None, '>90', 'green'),
+    ]
+    assert Patient.get_by_id(1).get_test_history(['sodium', 'potassium'], '20681-90000', 5) == {'sodium' : [('140', 'yellow')], 'potassium' : [('4.6', 'green')]}
+
+def test_add_test_results_upserts(baseline_db):
+    patient = Patient.get_by_id(1)
+    results = [('sodium', '141', 'green'), ('chloride', '<70', 'red')]
+    for _ in range(2):
+        patient.add_test_results('20681-82411', '16:45 30-Aug-19', results)
+
+    assert LabTestGroup.select().where(LabTestGroup.patient == patient).count() == 2
+    assert lab_tests(patient)['20681-82411'] == {
+        'sodium' : ('141', 'green', 141.0, None, 1),
+        'potassium' : ('4.6', 'green', 4.6, None, 1),
+        'chloride' : ('<70', 'red', 70.0, '<', 3),
+    }
+    history = sorted(LabTestHistory
+        .select(LabTestHistory.name, LabTestHistory.value)
+        .where((LabTestHistory.patient == patient) & (LabTestHistory.lab_number == '20681-82411'))
+        .tuples())
+    assert history == [('chloride', '<70'), ('potassium', '4.6'), ('sodium', '141')]
@@ -0,0 +1,64 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import os, sys, pickle
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+import pytest
+
+import glyphs
+
+CHAR_HEIGHT = 12
+CHAR_WIDTH = 8
+
+# A mostly blank 77 column line, as on most AUSLAB screens
+LINE_TEXT = 'AB'.ljust(60) + 'BA'.ljust(17)
+
+def make_templates():
+    # 1 = background, 0 = glyph, as in the pickled template files
+    rng = np.random.RandomState(0)
+    return {
+        ' ' : [np.ones((CHAR_HEIGHT, CHAR_WIDTH))],
+        'A' : [rng.randint(0, 2, (CHAR_HEIGHT, CHAR_WIDTH)).astype(float)],
+        'B' : [rng.randint(0, 2, (CHAR_HEIGHT, CHAR_WIDTH)).astype(float)],
+    }
+
+def render_line(templates, text, shift=0):
+    # Grey line image with dark glyphs, optionally shifted right off the character grid
+    line = np.concatenate([templates[x][0] for x in text], axis=1)
+    line = np.concatenate([np.ones((CHAR_HEIGHT, shift)), line[:, :line.shape[1] - shift]], axis=1)
+    return (line * 255).astype(np.uint8)
+
+@pytest.fixture
+def recognizer(tmp_path):
+    template_file_path = str(tmp_path / 'templates-test.dat')
+    with open(template_file_path, 'wb') as f:
+        pickle.dump([make_templates()], f)
+    recognizer = glyphs.BatchTemplateRecognizer({'template_file_path' : template_file_path})
+    recognizer._fallbackRecognizeLine = lambda raw_line: 'fallback'
+    return recognizer
+
+def test_aligned_line(recognizer):
+    assert recognizer.recognizeLines([render_line(make_templates(), LINE_TEXT)]) == [LINE_TEXT]
+
+@pytest.mark.parametrize('shift', [2, 3, 4, 5, 6])
+def test_misaligned_line_falls_back(recognizer, shift):
+    assert recognizer.recognizeLines([render_line(make_templates(), LINE_TEXT, shift)]) == ['fallback']
+
+def test_glyph_cache_file_is_trimmed(tmp_path):
+    path = str(tmp_path / 'glyphs-cache.sqlite3')
+    written = 3 * glyphs.GLYPH_CACHE_FLUSH_SIZE
+    cache = glyphs.GlyphCache(10, path)
+    for i in range(written):
+        cache.put(b'key%d' % i, 'A', 0)
+    cache.flush()
+    assert cache.db.execute('SELECT COUNT(*) FROM glyphs').fetchone()[0] == 10
+    cache.db.close()
+
+    # Reopened with a smaller limit, only the most recent glyphs are kept
+    cache = glyphs.GlyphCache(4, path)
+    assert cache.db.execute('SELECT key FROM glyphs ORDER BY rowid').fetchall() == [(b'key%d' % i,) for i in range(written - 4, written)]
+    assert list(cache.entries) == [b'key%d' % i for i in range(written - 4, written)]
+    cache.db.close()
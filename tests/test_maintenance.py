@@ -0,0 +1,68 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import os, sys, json, gzip, datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+import maintenance
+from database import PatientDatabase, Patient, LabTestGroup, LabTest, LabTestHistory
+
+NOW = datetime.datetime(2019, 9, 1)
+
+# UR -> [(lab number, collection time, [(test name, value, AUSLAB colour), ...]), ...]
+PATIENTS = {
+    '402710' : [
+        ('20681-10000', '08:00 01-Jan-19', [('sodium', '135', 'green'), ('potassium', '3.1', 'yellow')]),
+        ('20681-20000', '08:00 20-Aug-19', [('sodium', '137', 'green')]),
+        ('20681-30000', '16:45 30-Aug-19', [('sodium', '138', 'green')]),
+    ],
+    '123456' : [
+        ('20681-40000', '09:00 02-Feb-19', [('egfr', '>90', 'green')]),
+        ('20681-50000', '09:00 25-Aug-19', []),
+    ],
+}
+
+@pytest.fixture
+def patient_db(tmp_path):
+    patient_db = PatientDatabase(str(tmp_path / 'patients.db'))
+    for UR, groups in PATIENTS.items():
+        patient = Patient.create(UR=UR, name='PATIENT ' + UR, DOB='01-Jan-50')
+        for lab_number, collection_time, results in groups:
+            patient.add_test_results(lab_number, collection_time, results)
+    yield patient_db
+    patient_db.close()
+
+def group_ids(*lab_numbers):
+    return sorted(x.id for x in LabTestGroup.select().where(LabTestGroup.lab_number.in_(lab_numbers)))
+
+def test_expired_groups(patient_db):
+    assert sorted(maintenance.expired_groups(90, 0, NOW)) == group_ids('20681-10000', '20681-40000')
+    assert sorted(maintenance.expired_groups(0, 1, NOW)) == group_ids('20681-10000', '20681-20000', '20681-40000')
+    assert maintenance.expired_groups(0, 0, NOW) == []
+
+def test_archive_and_delete(patient_db, tmp_path):
+    expired = maintenance.expired_groups(90, 0, NOW)
+    kept = sorted(set(x.id for x in LabTestGroup.select()) - set(expired))
+    kept_tests = sorted(x.id for x in LabTest.select().where(LabTest.lab_test_group.in_(kept)))
+    kept_history = sorted(x.id for x in LabTestHistory.select().where(LabTestHistory.lab_number.not_in(['20681-10000', '20681-40000'])))
+
+    runner = maintenance.DatabaseMaintenance(patient_db, 90, 0, str(tmp_path / 'archive'))
+    archive_path = str(tmp_path / 'archive.jsonl.gz')
+    assert runner.archiveBatch([expired], archive_path) == (runner.compact,)
+
+    with gzip.open(archive_path, 'rt', encoding='utf-8') as f:
+        records = sorted((json.loads(x) for x in f), key=lambda x: x['lab_number'])
+    assert records == [
+        {'UR' : '402710', 'name' : 'PATIENT 402710', 'DOB' : '01-Jan-50', 'lab_number' : '20681-10000', 'collection_time' : '08:00 01-Jan-19',
+            'results' : [['sodium', '135', 'green'], ['potassium', '3.1', 'yellow']]},
+        {'UR' : '123456', 'name' : 'PATIENT 123456', 'DOB' : '01-Jan-50', 'lab_number' : '20681-40000', 'collection_time' : '09:00 02-Feb-19',
+            'results' : [['egfr', '>90', 'green']]},
+    ]
+
+    assert sorted(x.id for x in LabTestGroup.select()) == kept
+    assert sorted(x.id for x in LabTest.select()) == kept_tests
+    assert sorted(x.id for x in LabTestHistory.select()) == kept_history
+    assert Patient.select().count() == 2
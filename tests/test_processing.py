@@ -0,0 +1,49 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import os, sys, re
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+import processing
+from processing import regex_anchor
+
+# (pattern, line) pairs where the pattern matches the line
+MATCHING_PATTERNS = [
+    (r'Sodium\s+(?P<result>\d+)\s+', 'Sodium       138   mmol/L'),
+    (r'\x48gb\s+(?P<result>\d+)', 'Hgb    132'),
+    (r'(?x) Sod ium \s+ (?P<result>\d+)', 'Sodium   138'),
+    (r'(?i)sodium\s+(?P<result>\d+)', 'SODIUM   138'),
+    (r'(?!Corr )pCO2\s+(?P<result>[0-9\.]+)', 'pCO2     41.2'),
+    (r'(?P<result>\d+)\s+Hgb', '132 Hgb'),
+    (r'(Hgb)\s+\1\s+(?P<result>\d+)', 'Hgb Hgb 132'),
+    (r'\N{LATIN CAPITAL LETTER H}gb\s+(?P<result>\d+)', 'Hgb    132'),
+    (r'Bicarb\.\s+(?P<result>[0-9\.]+)', 'Bicarb.   28'),
+    (r'eGFR\s+(?P<result>\<?\>?\s*\d+)\s+', 'eGFR      >90   mL/min'),
+]
+
+@pytest.mark.parametrize('regex, line', MATCHING_PATTERNS)
+def test_match_line_agrees_with_search(regex, line):
+    extractor = processing.TestExtractor([{'name' : 'test', 'regex' : regex}])
+    expected = re.search(regex, line)
+    assert expected is not None
+    assert extractor.matchLine(line) == [('test', expected.group('result'), expected.span('result'))]
+
+@pytest.mark.parametrize('regex', [r'\x48gb\s+(?P<result>\d+)', r'(?x) Sod ium \s+ (?P<result>\d+)', r'(?!Corr )pCO2\s+', r'(a)\1'])
+def test_no_anchor_for_unsupported_syntax(regex):
+    assert regex_anchor(regex) is None
+
+def test_anchor_of_plain_pattern():
+    assert regex_anchor(r'Corr Ca\s+(?P<result>[0-9\.]+)\s+') == 'Corr Ca'
+    assert regex_anchor(r'Bicarb\.\s+(?P<result>[0-9\.]+)') == 'Bicarb.'
+
+def test_extract_skips_only_tests_without_a_colour():
+    extractor = processing.TestExtractor([{'name' : 'sodium', 'regex' : r'Sodium\s+(?P<result>\d+)'}, {'name' : 'potassium', 'regex' : r'Potassium\s+(?P<result>[0-9\.]+)'}])
+    def line_char_color(line, column):
+        if line == 1:
+            raise IndexError(column)
+        return 'green'
+    results = processing.extract_test_results(['Sodium   138', 'Potassium  4.6'], extractor, line_char_color)
+    assert results == [('sodium', '138', 'green')]